@@ -0,0 +1,110 @@
+import numpy as np
+from hashlib import sha1
+from os import stat
+from ArraySnapshot import ArraySnapshot
+
+
+class AlignmentsCache:
+    VERSION = 1
+    ARRAYS = ["reads", "read_offsets", "TIs", "TI_offsets", "alignment_offsets", "TI_codes", "scores"]
+
+    @staticmethod
+    def getCacheDirectory(alignmentsFile):
+        return alignmentsFile + ".cache"
+
+    @staticmethod
+    def getFileHash(fileName):
+        fileHash = sha1()
+        with open(fileName, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                fileHash.update(block)
+        return fileHash.hexdigest()
+
+    @staticmethod
+    def load(alignmentsFile):
+        cacheDirectory = AlignmentsCache.getCacheDirectory(alignmentsFile)
+        meta = ArraySnapshot.loadMeta(cacheDirectory)
+        if meta is None:
+            return None
+        fileStat = stat(alignmentsFile)
+
+        if meta["version"] != AlignmentsCache.VERSION:
+            return None
+        if meta["size"] != fileStat.st_size or meta["mtime"] != fileStat.st_mtime:
+            # file was touched or rewritten, the content decides
+            if meta["size"] != fileStat.st_size or meta["sha1"] != AlignmentsCache.getFileHash(alignmentsFile):
+                return None
+            meta["mtime"] = fileStat.st_mtime
+            ArraySnapshot.saveMeta(cacheDirectory, meta)
+
+        return CachedAlignments(ArraySnapshot.load(cacheDirectory, AlignmentsCache.ARRAYS))
+
+    @staticmethod
+    def save(alignmentsFile, alignments):
+        TICodes, TIs = {}, []
+        reads, alignmentLengths, codes, scores = [], [], [], []
+        for read, (readTIs, score) in alignments.items():
+            reads.append(read.encode())
+            alignmentLengths.append(len(readTIs))
+            scores.append(score)
+            for TI in readTIs:
+                code = TICodes.get(TI, None)
+                if code is None:
+                    code = TICodes[TI] = len(TIs)
+                    TIs.append(TI.encode())
+                codes.append(code)
+
+        arrays = {
+            "reads": np.frombuffer(b"".join(reads), dtype=np.uint8),
+            "read_offsets": ArraySnapshot.getOffsets([len(read) for read in reads]),
+            "TIs": np.frombuffer(b"".join(TIs), dtype=np.uint8),
+            "TI_offsets": ArraySnapshot.getOffsets([len(TI) for TI in TIs]),
+            "alignment_offsets": ArraySnapshot.getOffsets(alignmentLengths),
+            "TI_codes": np.asarray(codes, dtype=np.int32),
+            "scores": np.asarray(scores, dtype=np.float64)
+        }
+        fileStat = stat(alignmentsFile)
+        meta = {"version": AlignmentsCache.VERSION, "size": fileStat.st_size, "mtime": fileStat.st_mtime,
+                "sha1": AlignmentsCache.getFileHash(alignmentsFile)}
+        ArraySnapshot.save(AlignmentsCache.getCacheDirectory(alignmentsFile), arrays, meta)
+
+
+class CachedAlignments:
+    # read-only alignments dict (read -> (TIs, score)) over memory-mapped cache arrays
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.TIs = self.getStrings("TIs", "TI_offsets")
+        self.readIndex = None
+
+    def __len__(self):
+        return len(self.arrays["scores"])
+
+    def __iter__(self):
+        return iter(self.getStrings("reads", "read_offsets"))
+
+    def __contains__(self, read):
+        return self.getReadIndex().get(read, None) is not None
+
+    def __getitem__(self, read):
+        return self.getAlignment(self.getReadIndex()[read])
+
+    def getStrings(self, blobName, offsetsName):
+        # SAM read names and TIs are ASCII, so byte offsets are also string offsets
+        blob, offsets = bytes(self.arrays[blobName]).decode('ascii'), self.arrays[offsetsName].tolist()
+        return [blob[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+    def getReadIndex(self):
+        if self.readIndex is None:
+            self.readIndex = dict((read, i) for i, read in enumerate(self))
+        return self.readIndex
+
+    def getAlignment(self, i):
+        offsets = self.arrays["alignment_offsets"]
+        codes = self.arrays["TI_codes"][offsets[i]:offsets[i + 1]]
+        return [self.TIs[code] for code in codes.tolist()], float(self.arrays["scores"][i])
+
+    def items(self):
+        offsets, codes = self.arrays["alignment_offsets"].tolist(), self.arrays["TI_codes"].tolist()
+        scores = self.arrays["scores"].tolist()
+        for i, read in enumerate(self):
+            yield read, ([self.TIs[code] for code in codes[offsets[i]:offsets[i + 1]]], scores[i])
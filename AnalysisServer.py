@@ -0,0 +1,151 @@
+import json
+from collections import deque
+from argparse import ArgumentParser, Namespace
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock
+from time import time
+from DatabaseReducer import DatabaseReducer
+from BatchAnalyzer import analyzeSample, createPool, loadTaxonomyTree
+
+# POST /jobs with {"input": "<reads or SAM file>", "engine": ..., "compress": ..., "accelerated": ...}
+# returns the job id, GET /jobs/<id> returns its status and, when done, the abundances
+
+
+class AnalysisServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, processes=1, maxQueuedJobs=100, aligner="graphmap", maxFinishedJobs=1000,
+                 finishedJobsTTL=24 * 3600):
+        self.taxTree = loadTaxonomyTree()
+        self.pool = createPool(processes, self.taxTree)
+        self.maxQueuedJobs = maxQueuedJobs
+        self.maxFinishedJobs = maxFinishedJobs      # older finished jobs are forgotten
+        self.finishedJobsTTL = finishedJobsTTL      # seconds a finished job is kept
+        self.aligner = aligner
+        self.jobs = {}      # key - job id
+        self.finishedJobs = deque()     # finish time and id of finished jobs, oldest first
+        self.jobsCount = 0
+        self.queuedJobs = 0
+        self.lock = Lock()
+        HTTPServer.__init__(self, address, AnalysisRequestHandler)
+
+    def submitJob(self, request):
+        if not isinstance(request, dict):
+            raise ValueError("job must be a JSON object")
+        if not isinstance(request.get("input", None), str):
+            raise ValueError("job needs an input file path")
+        options = Namespace(aligner=self.aligner, engine=request.get("engine", "python"),
+                            compress=bool(request.get("compress", False)),
+                            accelerated=bool(request.get("accelerated", False)), cache=bool(request.get("cache", True)))
+        if options.engine not in ("python", "numpy"):
+            raise ValueError("unknown engine: {}".format(options.engine))
+
+        with self.lock:
+            self.evictFinishedJobs()
+            if self.queuedJobs >= self.maxQueuedJobs:
+                return None
+            self.queuedJobs += 1
+            self.jobsCount += 1
+            jobId = str(self.jobsCount)
+            job = self.jobs[jobId] = {"id": jobId, "input": request["input"], "status": "queued", "submitted": time()}
+            submittedJob = dict(job)
+
+        self.pool.apply_async(analyzeSample, (job["input"], options),
+                              callback=lambda result: self.finishJob(job, result[1], None),
+                              error_callback=lambda error: self.finishJob(job, None, error))
+        return submittedJob
+
+    def finishJob(self, job, result, error):
+        with self.lock:
+            self.queuedJobs -= 1
+            self.finishedJobs.append((time(), job["id"]))
+            job["time"] = time() - job["submitted"]
+            if error is not None:
+                job["status"], job["error"] = "failed", repr(error)
+            elif result is None:
+                job["status"], job["error"] = "failed", "Mapping failed."
+            else:
+                job["status"] = "done"
+                job["result"] = [{"TI": TI, "name": self.taxTree.taxonomyNames.get(TI, None), "abundance": pi}
+                                 for pi, TI in result]
+
+    def evictFinishedJobs(self):
+        # called with the lock held
+        expired = time() - self.finishedJobsTTL
+        while self.finishedJobs and (len(self.finishedJobs) > self.maxFinishedJobs
+                                     or self.finishedJobs[0][0] < expired):
+            finished, jobId = self.finishedJobs.popleft()
+            del self.jobs[jobId]
+
+    def getJob(self, jobId):
+        with self.lock:
+            self.evictFinishedJobs()
+            job = self.jobs.get(jobId, None)
+            return dict(job) if job is not None else None
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.pool.terminate()
+
+
+class AnalysisRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            return self.sendJson(404, {"error": "not found"})
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode())
+            job = self.server.submitJob(request)
+        except (ValueError, KeyError, TypeError) as error:
+            return self.sendJson(400, {"error": str(error)})
+
+        if job is None:
+            return self.sendJson(503, {"error": "too many queued jobs"})
+        self.sendJson(202, job)
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "jobs":
+            return self.sendJson(404, {"error": "not found"})
+
+        job = self.server.getJob(parts[1])
+        if job is None:
+            return self.sendJson(404, {"error": "unknown job"})
+        self.sendJson(200, job)
+
+    def sendJson(self, code, content):
+        body = json.dumps(content).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--port", type=int, default=8080, help="port on localhost")
+    parser.add_argument("--processes", type=int, default=1, help="jobs analyzed at the same time")
+    parser.add_argument("--max-queued", type=int, default=100, help="jobs accepted before requests are refused")
+    parser.add_argument("--keep-jobs", type=int, default=1000, help="finished jobs kept for GET requests")
+    parser.add_argument("--jobs-ttl", type=float, default=24 * 3600, help="seconds a finished job is kept")
+    parser.add_argument("--aligner", default="graphmap",
+                        help="aligner executable, called as: ALIGNER align -r DATABASE -d READS -o SAM")
+    args = parser.parse_args()
+
+    DatabaseReducer(args.processes).generate()
+
+    server = AnalysisServer(("127.0.0.1", args.port), args.processes, args.max_queued, args.aligner, args.keep_jobs,
+                            args.jobs_ttl)
+    print("Listening on 127.0.0.1:{}".format(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import json
+import numpy as np
+from os import getpid, makedirs, remove, replace
+from os.path import isfile, join
+
+
+class ArraySnapshot:
+    # directory of .npy arrays loaded memory-mapped and a meta.json written last,
+    # a snapshot without the meta file is never loaded
+
+    @staticmethod
+    def loadMeta(directory):
+        metaFile = join(directory, "meta.json")
+        if not isfile(metaFile):
+            return None
+
+        with open(metaFile) as f:
+            return json.load(f)
+
+    @staticmethod
+    def saveMeta(directory, meta):
+        metaFile = join(directory, "meta.json")
+        temporaryFile = ArraySnapshot.getTemporaryFile(metaFile)
+        with open(temporaryFile, 'w') as f:
+            json.dump(meta, f)
+        replace(temporaryFile, metaFile)
+
+    @staticmethod
+    def load(directory, names):
+        arrays = {}
+        for name in names:
+            arrays[name] = np.load(join(directory, name + ".npy"), mmap_mode='r')
+        return arrays
+
+    @staticmethod
+    def save(directory, arrays, meta):
+        metaFile = join(directory, "meta.json")
+        makedirs(directory, exist_ok=True)
+        if isfile(metaFile):
+            remove(metaFile)
+
+        # arrays are renamed over the old files, processes that have them memory-mapped keep the old contents
+        for name in arrays:
+            arrayFile = join(directory, name + ".npy")
+            temporaryFile = ArraySnapshot.getTemporaryFile(arrayFile)
+            with open(temporaryFile, 'wb') as f:
+                np.save(f, arrays[name])
+            replace(temporaryFile, arrayFile)
+
+        ArraySnapshot.saveMeta(directory, meta)
+
+    @staticmethod
+    def getTemporaryFile(fileName):
+        return "{}.{}.tmp".format(fileName, getpid())
+
+    @staticmethod
+    def getOffsets(lengths):
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return offsets
@@ -0,0 +1,117 @@
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from functools import partial
+from multiprocessing import get_context
+from os import listdir
+from os.path import isdir, join
+from pathlib import Path
+from signal import SIGINT, SIG_IGN, signal
+from time import time
+from EMAlgorithm import EMAlgorithm
+from DatabaseReducer import DatabaseReducer
+from TaxonomyTree import TaxonomyTree
+from PathogenAnalyzer import getAlignmentsFile, getSampleName, mapReads
+from res.ResourceFiles import REDUCED_DB_FILE
+
+READS_EXTENSIONS = (".fastq", ".fq", ".fasta", ".fa")
+
+# set before the pool is forked, so the workers share the loaded taxonomy copy-on-write
+sharedTaxTree = None
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("inputs", nargs="+", help="input files with reads or directories with them")
+    parser.add_argument("--output", default="alignments/out/abundances.tsv",
+                        help="combined abundance table of all samples")
+    parser.add_argument("--engine", choices=["python", "numpy"], default="python",
+                        help="implementation of the EM steps")
+    parser.add_argument("--compress", action="store_true",
+                        help="collapse reads into equivalence classes before EM")
+    parser.add_argument("--accelerated", action="store_true",
+                        help="use SQUAREM extrapolation between EM steps")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="samples analyzed at the same time")
+    parser.add_argument("--no-cache", dest="cache", action="store_false",
+                        help="do not read or write the binary alignments cache")
+    parser.add_argument("--aligner", default="graphmap",
+                        help="aligner executable, called as: ALIGNER align -r DATABASE -d READS -o SAM")
+    args = parser.parse_args()
+
+    inputFiles = getInputFiles(args.inputs)
+    print("Samples: {}".format(len(inputFiles)))
+
+    DatabaseReducer(args.processes).generate()
+
+    taxTree = loadTaxonomyTree()
+
+    results = {}
+    startTime = time()
+    with createPool(args.processes, taxTree) as pool:
+        for inputFile, result in pool.imap_unordered(partial(analyzeSample, options=args), inputFiles):
+            results[inputFile] = result
+            print("{}/{}\t{}\t{}".format(len(results), len(inputFiles), getSampleName(inputFile),
+                                         "---Done." if result is not None else "Mapping failed."))
+    print("\t\tTotal time: {:.3f} s".format(time() - startTime))
+
+    writeAbundances(args.output, inputFiles, results, taxTree)
+    print("Abundances written to {}".format(args.output))
+
+
+def getInputFiles(inputs):
+    inputFiles = []
+    for path in inputs:
+        if isdir(path):
+            inputFiles.extend(sorted(join(path, fileName) for fileName in listdir(path)
+                                     if fileName.endswith(READS_EXTENSIONS)))
+        else:
+            inputFiles.append(path)
+    return inputFiles
+
+
+def loadTaxonomyTree():
+    print("Loading the taxonomy tree...")
+    taxTree = TaxonomyTree()
+    taxTree.build()
+    print("---Done.")
+    return taxTree
+
+
+def createPool(processes, taxTree):
+    global sharedTaxTree
+
+    sharedTaxTree = taxTree
+    # interrupts are handled by the parent, which terminates the pool
+    return get_context("fork").Pool(max(processes, 1), signal, (SIGINT, SIG_IGN))
+
+
+def analyzeSample(inputFile, options):
+    # a SAM file is analyzed as it is, reads are mapped first;
+    # output of every sample goes to a log next to its alignments
+    alignmentsFile = inputFile if inputFile.endswith(".sam") else getAlignmentsFile(inputFile)
+
+    with open(alignmentsFile + ".log", 'w') as log, redirect_stdout(log):
+        if not Path(alignmentsFile).is_file():
+            if mapReads(options.aligner, REDUCED_DB_FILE, inputFile, alignmentsFile) != 0:
+                return inputFile, None
+
+        result = EMAlgorithm(sharedTaxTree).start(alignmentsFile, options.engine, options.compress,
+                                                  options.accelerated, 1, options.cache)
+    return inputFile, result
+
+
+def writeAbundances(outputFile, inputFiles, results, taxTree):
+    abundances = {}     # key - TI, abundance by sample
+    for sample in range(len(inputFiles)):
+        for pi, TI in results[inputFiles[sample]] or []:
+            abundances.setdefault(TI, [0] * len(inputFiles))[sample] = pi
+
+    with open(outputFile, 'w') as output:
+        output.write("\t".join(["TI", "name"] + [getSampleName(inputFile) for inputFile in inputFiles]) + "\n")
+        for TI in sorted(abundances, key=lambda TI: -sum(abundances[TI])):
+            name = taxTree.taxonomyNames.get(TI, None) or ""
+            output.write("\t".join([TI, name] + ["{:.8g}".format(pi) for pi in abundances[TI]]) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import json
+import pickle
+from hashlib import sha1
+from os import makedirs, replace, stat
+from os.path import isfile, join
+
+
+class Checkpoints:
+    VERSION = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @staticmethod
+    def getFingerprint(inputFiles, upstreamFingerprints=()):
+        # inputs are identified by path, size and modification time
+        inputs = [Checkpoints.getFileStat(inputFile) for inputFile in inputFiles]
+        key = json.dumps([Checkpoints.VERSION, inputs, list(upstreamFingerprints)])
+        return sha1(key.encode()).hexdigest()
+
+    @staticmethod
+    def getFileStat(fileName):
+        fileStat = stat(fileName)
+        return [fileName, fileStat.st_size, fileStat.st_mtime]
+
+    def getPaths(self, stage):
+        return join(self.directory, stage + ".json"), join(self.directory, stage + ".pickle")
+
+    def isValid(self, stage, fingerprint):
+        metaFile = self.getPaths(stage)[0]
+        if not isfile(metaFile):
+            return False
+
+        with open(metaFile) as f:
+            meta = json.load(f)
+        if meta["fingerprint"] != fingerprint:
+            return False
+        for output in meta["outputs"]:
+            if not isfile(output[0]) or Checkpoints.getFileStat(output[0]) != output:
+                return False
+        return True
+
+    def load(self, stage, fingerprint):
+        if not self.isValid(stage, fingerprint):
+            return None
+        with open(self.getPaths(stage)[1], 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, stage, fingerprint, artifact=None, outputFiles=()):
+        metaFile, artifactFile = self.getPaths(stage)
+        makedirs(self.directory, exist_ok=True)
+
+        # files are replaced only when fully written, an interrupted save leaves the old checkpoint
+        with open(artifactFile + ".tmp", 'wb') as f:
+            pickle.dump(artifact, f, pickle.HIGHEST_PROTOCOL)
+        replace(artifactFile + ".tmp", artifactFile)
+
+        meta = {"fingerprint": fingerprint, "outputs": [Checkpoints.getFileStat(output) for output in outputFiles]}
+        with open(metaFile + ".tmp", 'w') as f:
+            json.dump(meta, f)
+        replace(metaFile + ".tmp", metaFile)
@@ -0,0 +1,349 @@
+import re
+import numpy as np
+from array import array
+from bisect import bisect_left
+from os import stat
+from ArraySnapshot import ArraySnapshot
+
+
+class CompactTaxonomy:
+    # taxonomy as arrays indexed by position of the TI in the sorted taxIds array
+    VERSION = 2
+    ARRAYS = ["taxIds", "parents", "rankCodes", "names", "nameOffsets",
+              "lookupNames", "lookupOffsets", "lookupIndices", "firstChild", "nextSibling"]
+
+    def __init__(self, arrays, ranks):
+        self.arrays = arrays
+        self.ranks = ranks
+        for name in CompactTaxonomy.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.lookup = BlobStrings(self.lookupNames, self.lookupOffsets)
+
+    @staticmethod
+    def fromDumps(namesFile, nodesFile, databaseMode, printInfo=False):
+        SCIENTIFIC_NAME = "scientific name"
+        NOT_ALPHANUMERIC = re.compile('[^0-9a-zA-Z]+')
+
+        if printInfo:
+            print("Preparing taxonomy names...")
+        scientificTIs, scientificNames = array('q'), []
+        lookupTIs, lookupNames = array('q'), []
+        with open(namesFile) as f:
+            for line in f:
+                taxName = line.split('|')
+                TI = int(taxName[0])
+                name = taxName[1].strip()
+                if databaseMode:
+                    name = NOT_ALPHANUMERIC.sub('_', name)
+                name = name.encode()
+
+                lookupTIs.append(TI)
+                lookupNames.append(name)
+                if taxName[3].strip() == SCIENTIFIC_NAME:
+                    scientificTIs.append(TI)
+                    scientificNames.append(name)
+        if printInfo:
+            print("---Done.")
+            print("Preparing taxonomy nodes...")
+
+        nodeTIs, parentTIs, rankCodes, ranks, rankIndex = array('q'), array('q'), array('B'), [None], {None: 0}
+        with open(nodesFile) as f:
+            for line in f:
+                node = line.split('|')
+                rank = node[2].strip()
+                code = rankIndex.get(rank, None)
+                if code is None:
+                    code = rankIndex[rank] = len(ranks)
+                    ranks.append(rank)
+                nodeTIs.append(int(node[0]))
+                parentTIs.append(int(node[1]))
+                rankCodes.append(code)
+
+        arrays = {}
+        nodeTIs, parentTIs = np.frombuffer(nodeTIs, dtype=np.int64), np.frombuffer(parentTIs, dtype=np.int64)
+        taxIds = np.unique(np.concatenate([np.frombuffer(scientificTIs, dtype=np.int64),
+                                           np.frombuffer(lookupTIs, dtype=np.int64), nodeTIs, parentTIs]))
+        arrays["taxIds"] = taxIds
+
+        # nodes known only as parents have no rank and are their own parent, as the root
+        nodeIndices, parentIndices = np.searchsorted(taxIds, nodeTIs), np.searchsorted(taxIds, parentTIs)
+        parents = np.full(len(taxIds), -1, dtype=np.int32)
+        parents[parentIndices] = parentIndices
+        parents[nodeIndices] = parentIndices
+        arrays["parents"] = parents
+        arrays["rankCodes"] = np.zeros(len(taxIds), dtype=np.uint8)
+        arrays["rankCodes"][nodeIndices] = np.frombuffer(rankCodes, dtype=np.uint8)
+        arrays["firstChild"], arrays["nextSibling"] = CompactTaxonomy.getChildren(parents)
+
+        # the first scientific name of a TI is used
+        scientificIndices = np.searchsorted(taxIds, np.frombuffer(scientificTIs, dtype=np.int64))
+        names = [b""] * len(taxIds)
+        for i in reversed(range(len(scientificNames))):
+            names[scientificIndices[i]] = scientificNames[i]
+        arrays["names"], arrays["nameOffsets"] = CompactTaxonomy.getBlob(names)
+
+        # the last TI of a name is used
+        lookupIndices = np.searchsorted(taxIds, np.frombuffer(lookupTIs, dtype=np.int64)).astype(np.int32)
+        order = sorted(range(len(lookupNames)), key=lookupNames.__getitem__)
+        order = [order[k] for k in range(len(order))
+                 if k + 1 == len(order) or lookupNames[order[k]] != lookupNames[order[k + 1]]]
+        arrays["lookupNames"], arrays["lookupOffsets"] = CompactTaxonomy.getBlob([lookupNames[k] for k in order])
+        arrays["lookupIndices"] = lookupIndices[order]
+        if printInfo:
+            print("---Done.")
+
+        return CompactTaxonomy(arrays, ranks)
+
+    @staticmethod
+    def getBlob(strings):
+        return np.frombuffer(b"".join(strings), dtype=np.uint8), ArraySnapshot.getOffsets([len(s) for s in strings])
+
+    @staticmethod
+    def getChildren(parents):
+        # first child and next sibling of each node, root is not its own child
+        nodes = np.arange(len(parents), dtype=np.int32)
+        isChild = (parents >= 0) & (parents != nodes)
+        order = np.argsort(parents[isChild], kind='stable')
+        children, childParents = nodes[isChild][order], parents[isChild][order]
+
+        sameParent = childParents[1:] == childParents[:-1]
+        nextSibling = np.full(len(parents), -1, dtype=np.int32)
+        nextSibling[children[:-1][sameParent]] = children[1:][sameParent]
+
+        isFirst = np.concatenate([[True], ~sameParent]) if len(children) else np.zeros(0, dtype=bool)
+        firstChild = np.full(len(parents), -1, dtype=np.int32)
+        firstChild[childParents[isFirst]] = children[isFirst]
+        return firstChild, nextSibling
+
+    @staticmethod
+    def isSnapshotValid(directory, sources):
+        meta = ArraySnapshot.loadMeta(directory)
+        if meta is None:
+            return False
+        return meta["version"] == CompactTaxonomy.VERSION and meta["sources"] == CompactTaxonomy.getSourcesStat(sources)
+
+    @staticmethod
+    def getSourcesStat(sources):
+        sourcesStat = {}
+        for source in sources:
+            sourceStat = stat(source)
+            sourcesStat[source] = [sourceStat.st_size, sourceStat.st_mtime]
+        return sourcesStat
+
+    def save(self, directory, sources):
+        meta = {"version": CompactTaxonomy.VERSION, "sources": CompactTaxonomy.getSourcesStat(sources),
+                "ranks": self.ranks}
+        ArraySnapshot.save(directory, dict((name, self.arrays[name]) for name in CompactTaxonomy.ARRAYS), meta)
+
+    @staticmethod
+    def load(directory):
+        meta = ArraySnapshot.loadMeta(directory)
+        return CompactTaxonomy(ArraySnapshot.load(directory, CompactTaxonomy.ARRAYS), meta["ranks"])
+
+    def getIndex(self, TI):
+        try:
+            TI = int(TI)
+        except (TypeError, ValueError):
+            return None
+
+        i = int(np.searchsorted(self.taxIds, TI))
+        if i < len(self.taxIds) and self.taxIds[i] == TI:
+            return i
+        return None
+
+    def getTaxId(self, i):
+        return str(self.taxIds[i])
+
+    def getName(self, i):
+        start, end = self.nameOffsets[i], self.nameOffsets[i + 1]
+        return bytes(self.names[start:end]).decode() if end > start else None
+
+    def getRank(self, i):
+        return self.ranks[self.rankCodes[i]]
+
+    def getParentIndex(self, i):
+        parent = int(self.parents[i])
+        return parent if parent >= 0 else None
+
+    def getChildIndices(self, i):
+        children = []
+        child = int(self.firstChild[i])
+        while child >= 0:
+            children.append(child)
+            child = int(self.nextSibling[child])
+        return children
+
+    def getSubtreeRanges(self):
+        # preorder numbers, the subtree of node i is numbered enter[i]..exit[i]
+        parents, firstChild, nextSibling = self.parents.tolist(), self.firstChild.tolist(), self.nextSibling.tolist()
+        enter, exit = [-1] * len(parents), [-1] * len(parents)
+        counter = 0
+
+        for root in range(len(parents)):
+            if parents[root] != root:
+                continue
+            node = root
+            enter[node], counter = counter, counter + 1
+            while node is not None:
+                if firstChild[node] >= 0:
+                    node = firstChild[node]
+                    enter[node], counter = counter, counter + 1
+                    continue
+
+                # go up until a node with a next sibling
+                while node is not None:
+                    exit[node] = counter - 1
+                    if node == root:
+                        node = None
+                    elif nextSibling[node] >= 0:
+                        node = nextSibling[node]
+                        enter[node], counter = counter, counter + 1
+                        break
+                    else:
+                        node = parents[node]
+
+        return np.asarray(enter, dtype=np.int64), np.asarray(exit, dtype=np.int64)
+
+    def getParentArray(self):
+        # roots (and nodes without a parent) point to themselves
+        parents = np.asarray(self.parents, dtype=np.int64)
+        return np.where(parents >= 0, parents, np.arange(len(parents)))
+
+    def getRankAncestors(self, code):
+        # closest ancestor (or the node itself) with the rank code, -1 if there is none
+        jump = np.where(np.asarray(self.rankCodes) == code, np.arange(len(self.parents)), self.getParentArray())
+        for k in range(len(jump).bit_length() + 1):
+            nextJump = jump[jump]
+            if np.array_equal(nextJump, jump):
+                break
+            jump = nextJump
+        return np.where(np.asarray(self.rankCodes)[jump] == code, jump, -1).astype(np.int32)
+
+    def getIndexByName(self, name):
+        name = name.encode()
+        i = bisect_left(self.lookup, name)
+        if i < len(self.lookup) and self.lookup[i] == name:
+            return int(self.lookupIndices[i])
+        return None
+
+
+class BlobStrings:
+    # sequence of byte strings stored in one blob, used for binary search
+    def __init__(self, blob, offsets):
+        self.blob, self.offsets = blob, offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]])
+
+
+class TaxonomyNodeView:
+    # read-only TaxonomyTreeNode backed by CompactTaxonomy
+    __slots__ = ["taxonomy", "index"]
+
+    def __init__(self, taxonomy, index):
+        self.taxonomy, self.index = taxonomy, index
+
+    @property
+    def taxId(self):
+        return self.taxonomy.getTaxId(self.index)
+
+    @property
+    def name(self):
+        return self.taxonomy.getName(self.index)
+
+    @property
+    def rank(self):
+        return self.taxonomy.getRank(self.index)
+
+    @property
+    def parent(self):
+        parent = self.taxonomy.getParentIndex(self.index)
+        return TaxonomyNodeView(self.taxonomy, parent) if parent is not None else None
+
+    @property
+    def children(self):
+        return [TaxonomyNodeView(self.taxonomy, child) for child in self.taxonomy.getChildIndices(self.index)]
+
+    def hasChildren(self):
+        return self.taxonomy.firstChild[self.index] >= 0
+
+
+class CompactTaxonomyMap:
+    # read-only dict-like access to CompactTaxonomy, clear() only drops the reference
+    def __init__(self, taxonomy):
+        self.taxonomy = taxonomy
+        self.length = None
+
+    def getIndex(self, key):
+        return None
+
+    def getValue(self, i):
+        return None
+
+    def get(self, key, default=None):
+        i = self.getIndex(key) if self.taxonomy is not None else None
+        return self.getValue(i) if i is not None else default
+
+    def __getitem__(self, key):
+        value = self.get(key, None)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, None) is not None
+
+    def clear(self):
+        self.taxonomy = None
+        self.length = 0
+
+
+class CompactTaxonomyNames(CompactTaxonomyMap):
+    # TI -> scientific name
+    def getIndex(self, TI):
+        i = self.taxonomy.getIndex(TI)
+        if i is not None and self.taxonomy.nameOffsets[i + 1] > self.taxonomy.nameOffsets[i]:
+            return i
+        return None
+
+    def getValue(self, i):
+        return self.taxonomy.getName(i)
+
+    def __len__(self):
+        if self.length is None:
+            self.length = int(np.count_nonzero(np.diff(self.taxonomy.nameOffsets)))
+        return self.length
+
+
+class CompactTaxonomyNodes(CompactTaxonomyMap):
+    # TI -> TaxonomyNodeView
+    def getIndex(self, TI):
+        i = self.taxonomy.getIndex(TI)
+        if i is not None and self.taxonomy.parents[i] >= 0:
+            return i
+        return None
+
+    def getValue(self, i):
+        return TaxonomyNodeView(self.taxonomy, i)
+
+    def __len__(self):
+        if self.length is None:
+            self.length = int(np.count_nonzero(np.asarray(self.taxonomy.parents) >= 0))
+        return self.length
+
+
+class CompactTaxonomyIDs(CompactTaxonomyMap):
+    # taxName -> TI
+    def getIndex(self, name):
+        return self.taxonomy.getIndexByName(name)
+
+    def getValue(self, i):
+        return self.taxonomy.getTaxId(i)
+
+    def __len__(self):
+        if self.length is None:
+            self.length = len(self.taxonomy.lookup)
+        return self.length
@@ -1,21 +1,158 @@
-from itertools import zip_longest
+import heapq
+import re
+from ast import literal_eval
+from os import makedirs
+from os.path import abspath, dirname, isdir, isfile, join
+from itertools import groupby, islice, zip_longest
+from shutil import rmtree
+from tempfile import TemporaryDirectory
+from multiprocessing import get_context
+from Checkpoints import Checkpoints
+from Metrics import Metrics
 from TaxonomyTree import TaxonomyTree
 from res.ResourceFiles import STRAINS_ASSEMBLY_FILE, MARKERS_FILE, NOT_PAIRED_CLADES_FILE,\
-    CODING_SEQUENCES_FILE, REDUCED_DB_FILE
+    CODING_SEQUENCES_FILE, REDUCED_DB_FILE, NAMES_FILE, NODES_FILE
 
 
 class DatabaseReducer:
-    def __init__(self):
+    MARKERS_CHUNK_SIZE = 10000
+    PAIRING_RUN_SIZE = 1000000
+    MARKER_CLADE = re.compile(r"'clade':\s*'([^'\\]*)'")
+    MARKER_EXT = re.compile(r"'ext':\s*(?:set\()?\[([^\]]*)\]")      # MetaPhlAn2 writes ext as set([...])
+    MARKER_SET = re.compile(r"set\((\[[^\]]*\])\)")
+    MARKER_STRING = re.compile(r"'([^'\\]*)'")
+
+    def __init__(self, processes=1, streamingPairing=False, shards=1, rebuild=False):
         self.taxTree = TaxonomyTree(databaseMode=True)
+        self.processes = processes  # processes for parsing the markers file
+        self.streamingPairing = streamingPairing  # pair markers through sorted runs on disk
+        self.shards = shards        # reduced database is also split into this many shards
+        self.rebuild = rebuild      # build the reduced database even if it was built without checkpoints
         self.strainAssemblies = {}  # key = assembly
         self.strainTIByName = {}    # key = taxName
         self.markers = {}           # key = GI, position
+        self.markerRuns = []        # sorted runs of GI, position, line and TIs when pairing is streamed
+        self.checkpoints = Checkpoints(REDUCED_DB_FILE + ".checkpoints")
 
     def generate(self):
-        self.taxTree.build()
-        self.parseStrainsAssemblyFile(STRAINS_ASSEMBLY_FILE)
-        self.parseMarkersFile(MARKERS_FILE, NOT_PAIRED_CLADES_FILE)
-        self.pairMarkers(CODING_SEQUENCES_FILE, REDUCED_DB_FILE)
+        inputFiles = [NAMES_FILE, NODES_FILE, STRAINS_ASSEMBLY_FILE, MARKERS_FILE, CODING_SEQUENCES_FILE]
+        if isfile(REDUCED_DB_FILE) and not all(isfile(inputFile) for inputFile in inputFiles):
+            print("Database sources not found, using the existing reduced database.")
+            if self.shards > 1:
+                self.generateShards(REDUCED_DB_FILE)
+            return
+
+        # each stage is keyed by its input files and the keys of the stages it depends on
+        strainsKey = Checkpoints.getFingerprint([STRAINS_ASSEMBLY_FILE])
+        markersKey = Checkpoints.getFingerprint([NAMES_FILE, NODES_FILE, MARKERS_FILE], [strainsKey])
+        pairingKey = Checkpoints.getFingerprint([CODING_SEQUENCES_FILE], [markersKey])
+
+        if self.checkpoints.isValid("pairing", pairingKey):
+            print("Reduced database is up to date.")
+        elif isfile(REDUCED_DB_FILE) and not isdir(self.checkpoints.directory) and not self.rebuild:
+            # a database built before checkpoints is taken to match the current sources
+            print("Using the existing reduced database, it is built again only with --rebuild.")
+            if not isfile(REDUCED_DB_FILE + ".fai"):
+                self.writeIndex(REDUCED_DB_FILE)
+            self.checkpoints.save("pairing", pairingKey, outputFiles=[REDUCED_DB_FILE, REDUCED_DB_FILE + ".fai"])
+        else:
+            with Metrics.stage("database_reducer") as stage:
+                self.buildReducedDatabase(strainsKey, markersKey, pairingKey)
+                stage.records = len(self.markers)
+
+        if self.shards > 1:
+            with Metrics.stage("database_shards") as stage:
+                self.generateShards(REDUCED_DB_FILE)
+                stage.records = self.shards
+
+    def buildReducedDatabase(self, strainsKey, markersKey, pairingKey):
+        # streamed pairing never fills the markers map, its checkpoint points at the sorted runs
+        markersStage = "marker_runs" if self.streamingPairing else "markers"
+        markers = self.checkpoints.load(markersStage, markersKey)
+        if markers is not None:
+            print("Loaded markers checkpoint.")
+            if self.streamingPairing:
+                self.markerRuns, markersCount = markers
+            else:
+                self.markers = markers
+                markersCount = len(self.markers)
+        else:
+            self.taxTree.build()
+            strains = self.checkpoints.load("strains", strainsKey)
+            if strains is not None:
+                print("Loaded strains assemblies checkpoint.")
+                self.strainAssemblies, self.strainTIByName = strains
+            else:
+                with Metrics.stage("reducer_strains") as stage:
+                    self.parseStrainsAssemblyFile(STRAINS_ASSEMBLY_FILE)
+                    stage.records = len(self.strainAssemblies)
+                self.checkpoints.save("strains", strainsKey, (self.strainAssemblies, self.strainTIByName))
+
+            with Metrics.stage("reducer_markers") as stage:
+                markersCount = stage.records = self.parseMarkersFile(MARKERS_FILE, NOT_PAIRED_CLADES_FILE)
+            if self.streamingPairing:
+                self.checkpoints.save(markersStage, markersKey, (self.markerRuns, markersCount),
+                                      outputFiles=self.markerRuns)
+            else:
+                self.checkpoints.save(markersStage, markersKey, self.markers)
+
+        with Metrics.stage("reducer_pairing") as stage:
+            stage.records = markersCount
+            self.pairMarkers(CODING_SEQUENCES_FILE, REDUCED_DB_FILE)
+        self.checkpoints.save("pairing", pairingKey, outputFiles=[REDUCED_DB_FILE, REDUCED_DB_FILE + ".fai"])
+
+    def generateShards(self, reducedDatabase):
+        if not isfile(reducedDatabase + ".fai"):
+            self.writeIndex(reducedDatabase)
+
+        shardFiles = self.getShardFiles(reducedDatabase, self.shards)
+        shardsKey = Checkpoints.getFingerprint([reducedDatabase, reducedDatabase + ".fai"], [str(self.shards)])
+        if self.checkpoints.isValid("shards", shardsKey):
+            return
+
+        print("Writing database shards...")
+        records = []
+        with open(reducedDatabase + ".fai") as index:
+            for line in index:
+                name, length, offset = line.split("\t")[:3]
+                records.append((int(length), int(offset), name))
+
+        # longest sequences first, each into the currently smallest shard
+        shardSizes = [(0, shard) for shard in range(self.shards)]
+        shardRecords = [[] for shard in range(self.shards)]
+        for record in sorted(records, reverse=True):
+            size, shard = heapq.heappop(shardSizes)
+            shardRecords[shard].append(record)
+            heapq.heappush(shardSizes, (size + record[0], shard))
+
+        with open(reducedDatabase, 'rb') as db:
+            for shard in range(self.shards):
+                with open(shardFiles[shard], 'wb') as shardDb, open(shardFiles[shard] + ".fai", 'w') as index:
+                    for length, offset, name in sorted(shardRecords[shard], key=lambda record: record[1]):
+                        db.seek(offset)
+                        GI, TIs = name.split("|")[1], name.split("|")[3]
+                        self.writeRecord(shardDb, index, GI, TIs, db.read(length))
+
+        for size, shard in sorted(shardSizes, key=lambda shardSize: shardSize[1]):
+            print("\t\tShard {}: {} sequences, {} bases".format(shard, len(shardRecords[shard]), size))
+        self.checkpoints.save("shards", shardsKey, outputFiles=shardFiles)
+        print("---Done.")
+
+    @staticmethod
+    def getShardFiles(reducedDatabase, shardsCount):
+        return ["{}.shard{}of{}.fa".format(reducedDatabase, shard, shardsCount) for shard in range(shardsCount)]
+
+    @staticmethod
+    def writeIndex(reducedDatabase):
+        # index of a reduced database written before indexes were added
+        with open(reducedDatabase, 'rb') as db, open(reducedDatabase + ".fai", 'w') as index:
+            offset = 0
+            for line1, line2 in zip_longest(*[db] * 2):
+                sequence = line2.rstrip(b"\n")
+                name = line1[1:].strip().decode()
+                offset += len(line1)
+                index.write("{}\t{}\t{}\t{}\t{}\n".format(name, len(sequence), offset, len(sequence), len(sequence) + 1))
+                offset += len(line2)
 
     def parseStrainsAssemblyFile(self, assemblyFile):
         print("Preparing strains assemblies...")
@@ -35,92 +172,131 @@ class DatabaseReducer:
         print("---Done.")
 
     def parseMarkersFile(self, markersFile, notPairedCladesFile):
+        # returns the number of markers kept for pairing
         print("Preparing markers...")
 
-        markersWithNoTIs = 0
+        counts = {"markers": 0, "markersWithNoTIs": 0}
         with open(markersFile, 'r') as f1, open(notPairedCladesFile, 'w') as f2:
-            for line in f1:
-                marker = line.strip().split("\t")
-                giInfo = marker[0]
-
-                if giInfo.startswith("gi|"):
-                    GI = giInfo.split('|')[1]
-                    position = giInfo.split('|')[-1].replace(':', '')
-                    info = eval(marker[1])
-                    clade, ext = info["clade"].strip(), info["ext"]
-                    rank, cladeName = clade.split('__')[0], clade.split('__')[1]
-
-                    cladeTI = self.taxTree.taxIDFromName.get(cladeName, "not found")
-                    taxNode = self.taxTree.taxNodes.get(cladeTI, None)
-
-                    if taxNode is not None:
-                        # if rank is not species, make clade to species level
-                        if rank != 's':
-                            speciesTIs = self.getSpecies(taxNode) | self.getTIsFromExt(ext)
-                        else:
-                            speciesTIs = self.getTIsFromExt(ext) | {taxNode.taxId}
-
-                        self.markers[GI, position] = speciesTIs
-
-                    else:
-                        # if clade name is strain assembly
-                        if rank == 't':
-                            TI = self.strainAssemblies.get(cladeName, None)
-                            if TI is not None:
-                                speciesTIs = self.getTIsFromExt(ext) | {TI}
-                                self.markers[GI, position] = speciesTIs
-
-                            else:
-                                f2.write(cladeName + "\n")
-                                speciesTIs = self.getTIsFromExt(ext)
-
-                                if len(speciesTIs) > 0:
-                                    self.markers[GI, position] = speciesTIs
-                                else:
-                                    markersWithNoTIs += 1
-
-                        else:
-                            # try with strain names
-                            TI = self.strainTIByName.get(cladeName, None)
-                            if TI is not None:
-                                speciesTIs = self.getTIsFromExt(ext) | {TI}
-                                self.markers[GI, position] = speciesTIs
-
-                            else:
-                                f2.write(cladeName + "\n")
-                                speciesTIs = self.getTIsFromExt(ext)
-
-                                if len(speciesTIs) > 0:
-                                    self.markers[GI, position] = speciesTIs
-                                else:
-                                    markersWithNoTIs += 1
-
-        self.printMarkersStatistics(markersWithNoTIs)
+            markers = self.getPairableMarkers(f1, f2, counts)
+            if self.streamingPairing:
+                runsDirectory = join(self.checkpoints.directory, "marker_runs")
+                rmtree(runsDirectory, ignore_errors=True)
+                makedirs(runsDirectory)
+                self.markerRuns = self.writeSortedRuns(
+                    ((GI, position, str(line), ",".join(TIs)) for GI, position, line, TIs in markers),
+                    runsDirectory, "markers", DatabaseReducer.getMarkerRecordKey)
+            else:
+                for GI, position, line, speciesTIs in markers:
+                    self.markers[GI, position] = speciesTIs
+                counts["markers"] = len(self.markers)
+
+        self.printMarkersStatistics(counts["markersWithNoTIs"], counts["markers"])
         self.taxTree.printNodesStatistic()
 
         self.strainAssemblies.clear()
         self.strainTIByName.clear()
         self.taxTree.taxNodes.clear()
         self.taxTree.taxIDFromName.clear()
+        self.taxTree.clearSpeciesIndex()
         print("---Done.")
+        return counts["markers"]
+
+    def getPairableMarkers(self, markersLines, notPairedCladesFile, counts):
+        # yields GI, position, line number and TIs of the markers that can be paired
+        for line, (GI, position, speciesTIs, notPairedClade) in enumerate(self.getParsedMarkers(markersLines)):
+            if notPairedClade is not None:
+                notPairedCladesFile.write(notPairedClade + "\n")
+                if len(speciesTIs) == 0:
+                    counts["markersWithNoTIs"] += 1
+                    continue
+
+            counts["markers"] += 1
+            yield GI, position, line, speciesTIs
+
+    def getParsedMarkers(self, markersLines):
+        global sharedReducer
+
+        if self.processes <= 1:
+            for line in markersLines:
+                parsedMarker = self.parseMarker(line)
+                if parsedMarker is not None:
+                    yield parsedMarker
+            return
+
+        # workers are forked after the lookup tables are ready and only read them
+        if self.taxTree.compact:
+            self.taxTree.getSpeciesIndex()
+        sharedReducer = self
+        chunks = iter(lambda: list(islice(markersLines, DatabaseReducer.MARKERS_CHUNK_SIZE)), [])
+        with get_context("fork").Pool(self.processes) as pool:
+            for parsedMarkers in pool.imap(parseMarkersChunk, chunks):
+                for parsedMarker in parsedMarkers:
+                    yield parsedMarker
+        sharedReducer = None
+
+    def parseMarker(self, line):
+        # returns GI, position, species TIs and the clade name if it was not paired with a TI
+        marker = line.strip().split("\t")
+        giInfo = marker[0]
+        if not giInfo.startswith("gi|"):
+            return None
+
+        GI = giInfo.split('|')[1]
+        position = giInfo.split('|')[-1].replace(':', '')
+        clade, ext = self.decodeMarkerInfo(marker[1])
+        rank, cladeName = clade.split('__')[0], clade.split('__')[1]
+
+        cladeTI = self.taxTree.taxIDFromName.get(cladeName, "not found")
+        taxNode = self.taxTree.taxNodes.get(cladeTI, None)
+
+        if taxNode is not None:
+            # if rank is not species, make clade to species level
+            if rank != 's':
+                return GI, position, self.getSpeciesTIs(taxNode) | self.getTIsFromExt(ext), None
+            return GI, position, self.getTIsFromExt(ext) | {taxNode.taxId}, None
+
+        if rank == 't':
+            # if clade name is strain assembly
+            TI = self.strainAssemblies.get(cladeName, None)
+        else:
+            # try with strain names
+            TI = self.strainTIByName.get(cladeName, None)
+
+        if TI is not None:
+            return GI, position, self.getTIsFromExt(ext) | {TI}, None
+        return GI, position, self.getTIsFromExt(ext), cladeName
+
+    @staticmethod
+    def decodeMarkerInfo(info):
+        # markers info is a Python dict literal, clade and ext are read without evaluating it
+        clade = DatabaseReducer.MARKER_CLADE.search(info)
+        ext = DatabaseReducer.MARKER_EXT.search(info)
+        if clade is not None and ext is not None:
+            return clade.group(1).strip(), DatabaseReducer.MARKER_STRING.findall(ext.group(1))
+
+        # set([...]) is not a literal, its list is read instead
+        info = literal_eval(DatabaseReducer.MARKER_SET.sub(r"\1", info))
+        return info["clade"].strip(), info["ext"]
 
     def pairMarkers(self, codingSequencesFile, reducedDatabase):
+        if self.streamingPairing:
+            self.pairMarkersStreaming(codingSequencesFile, reducedDatabase)
+            return
+
         print("Pairing markers...")
         paired, notPaired = 0, 0
 
-        with open(codingSequencesFile, 'r') as f, open(reducedDatabase, 'w') as db:
+        with open(codingSequencesFile, 'r') as f, open(reducedDatabase, 'wb') as db, \
+                open(reducedDatabase + ".fai", 'w') as index:
             for line1, line2 in zip_longest(*[f] * 2):
-                marker = line1.strip().split("\t")
-                GI = marker[0].split("|")[1]
-                position = marker[0].split("|")[4].replace(':', '')
+                GI, position = self.getSequenceKey(line1)
 
                 TIs = self.markers.get((GI, position), None)
                 self.markers.pop((GI, position), None)
 
                 if (TIs is not None) and len(TIs) != 0:
                     paired += 1
-                    db.write(">gi|" + GI + "|ti|" + ",".join(TIs) + "\n")
-                    db.write(line2.strip() + "\n")
+                    self.writeRecord(db, index, GI, ",".join(TIs), line2.strip().encode())
                 else:
                     notPaired += 1
 
@@ -129,6 +305,103 @@ class DatabaseReducer:
         self.markers.clear()
         print("---Done.")
 
+    def pairMarkersStreaming(self, codingSequencesFile, reducedDatabase):
+        # sequence keys are spilled to sorted runs and merge-joined with the markers runs,
+        # the joined pairs are sorted by sequence offset and written in file order
+        print("Pairing markers (streaming)...")
+        paired, sequencesCount, joinCounts = 0, 0, {"notPairedMarkers": 0}
+
+        with TemporaryDirectory(dir=dirname(abspath(reducedDatabase))) as runsDirectory:
+            sequenceRuns = self.writeSortedRuns(self.getSequenceKeys(codingSequencesFile), runsDirectory,
+                                                "sequences", lambda record: (record[0], record[1], int(record[2])))
+            pairs = self.joinMarkers(self.markerRuns, sequenceRuns, joinCounts)
+            pairRuns = self.writeSortedRuns(pairs, runsDirectory, "pairs", lambda record: int(record[0]))
+            pairs = heapq.merge(*[self.readRun(run) for run in pairRuns], key=lambda record: int(record[0]))
+            pair = next(pairs, None)
+
+            with open(codingSequencesFile, 'rb') as f, open(reducedDatabase, 'wb') as db, \
+                    open(reducedDatabase + ".fai", 'w') as index:
+                offset = 0
+                for line1, line2 in zip_longest(*[f] * 2):
+                    if pair is not None and int(pair[0]) == offset:
+                        paired += 1
+                        GI = self.getSequenceKey(line1.decode())[0]
+                        self.writeRecord(db, index, GI, pair[1], line2.strip())
+                        pair = next(pairs, None)
+                    offset += len(line1) + len(line2)
+                    sequencesCount += 1
+
+        self.printPairingMarkersStatistics(paired, sequencesCount - paired, joinCounts["notPairedMarkers"])
+        self.taxTree.taxonomyNames.clear()
+        print("---Done.")
+
+    def getSequenceKeys(self, codingSequencesFile):
+        offset = 0
+        with open(codingSequencesFile, 'rb') as f:
+            for line1, line2 in zip_longest(*[f] * 2):
+                GI, position = self.getSequenceKey(line1.decode())
+                yield GI, position, str(offset)
+                offset += len(line1) + len(line2)
+
+    def joinMarkers(self, markerRuns, sequenceRuns, joinCounts):
+        # yields sequence offset and TIs for the first sequence of every marker with TIs,
+        # of markers with the same key the last line is kept, as in the markers map
+        markers = heapq.merge(*[self.readRun(run) for run in markerRuns], key=DatabaseReducer.getMarkerRecordKey)
+        markers = (list(records)[-1] for key, records in groupby(markers, lambda record: (record[0], record[1])))
+        sequences = heapq.merge(*[self.readRun(run) for run in sequenceRuns],
+                                key=lambda record: (record[0], record[1], int(record[2])))
+        marker = next(markers, None)
+
+        for GI, position, offset in sequences:
+            while marker is not None and (marker[0], marker[1]) < (GI, position):
+                joinCounts["notPairedMarkers"] += 1
+                marker = next(markers, None)
+
+            if marker is not None and (marker[0], marker[1]) == (GI, position):
+                if marker[3]:
+                    yield offset, marker[3]
+                marker = next(markers, None)
+
+        while marker is not None:
+            joinCounts["notPairedMarkers"] += 1
+            marker = next(markers, None)
+
+    def writeSortedRuns(self, records, runsDirectory, name, key):
+        runs = []
+        for run in iter(lambda: list(islice(records, DatabaseReducer.PAIRING_RUN_SIZE)), []):
+            run.sort(key=key)
+            runs.append(join(runsDirectory, "{}{}.tsv".format(name, len(runs))))
+            with open(runs[-1], 'w') as f:
+                for record in run:
+                    f.write("\t".join(record) + "\n")
+        return runs
+
+    @staticmethod
+    def getMarkerRecordKey(record):
+        return record[0], record[1], int(record[2])
+
+    @staticmethod
+    def readRun(run):
+        with open(run) as f:
+            for line in f:
+                yield tuple(line.rstrip("\n").split("\t"))
+
+    @staticmethod
+    def getSequenceKey(header):
+        marker = header.strip().split("\t")
+        GI = marker[0].split("|")[1]
+        position = marker[0].split("|")[4].replace(':', '')
+        return GI, position
+
+    @staticmethod
+    def writeRecord(db, index, GI, TIs, sequence):
+        # one-line FASTA record and its samtools faidx entry
+        header = "gi|" + GI + "|ti|" + TIs
+        db.write((">" + header + "\n").encode())
+        offset = db.tell()
+        db.write(sequence + b"\n")
+        index.write("{}\t{}\t{}\t{}\t{}\n".format(header, len(sequence), offset, len(sequence), len(sequence) + 1))
+
     def getTIsFromExt(self, ext):
         TIs = set()
         for assembly in ext:
@@ -137,6 +410,12 @@ class DatabaseReducer:
                 TIs.add(TI)
         return TIs
 
+    def getSpeciesTIs(self, taxNode):
+        # compact trees answer from a precomputed index instead of walking the subtree
+        if self.taxTree.compact:
+            return self.taxTree.getDescendantSpecies(taxNode.taxId)
+        return self.getSpecies(taxNode)
+
     @staticmethod
     def getAllChildNodes(taxNode):
         SPECIES_RANK = "species"
@@ -179,12 +458,27 @@ class DatabaseReducer:
 
         return speciesTIs
 
-    def printMarkersStatistics(self, markersWithNoTIsCount):
+    @staticmethod
+    def printMarkersStatistics(markersWithNoTIsCount, markersCount):
         if markersWithNoTIsCount > 0:
             print("\t\tMarkers with no TIs: " + str(markersWithNoTIsCount))
-        print("\t\tRemaining markers: " + str(len(self.markers)))
+        print("\t\tRemaining markers: " + str(markersCount))
 
-    def printPairingMarkersStatistics(self, pairedCount, notPairedCount):
+    def printPairingMarkersStatistics(self, pairedCount, notPairedCount, notPairedMarkersCount=None):
+        if notPairedMarkersCount is None:
+            notPairedMarkersCount = len(self.markers)
         print("\t\tPaired: " + str(pairedCount))
         print("\t\tNot paired sequences: " + str(notPairedCount))
-        print("\t\tNot paired markers: " + str(len(self.markers)))
+        print("\t\tNot paired markers: " + str(notPairedMarkersCount))
+
+
+sharedReducer = None
+
+
+def parseMarkersChunk(lines):
+    parsedMarkers = []
+    for line in lines:
+        parsedMarker = sharedReducer.parseMarker(line)
+        if parsedMarker is not None:
+            parsedMarkers.append(parsedMarker)
+    return parsedMarkers
@@ -1,111 +1,152 @@
 import math
+import numpy as np
+from time import time
 from TaxonomyTree import TaxonomyTree
+from NumpyEMEngine import NumpyEMEngine
+from SamParser import SamParser
+from AlignmentsCache import AlignmentsCache
+from Metrics import Metrics
 from threading import Thread
-from multiprocessing import Process
+from multiprocessing import Process, get_context
 
 
 class EMAlgorithm:
-    def __init__(self):
-        self.taxTree = TaxonomyTree()
+    MAJOR_RANKS = ["superkingdom", "phylum", "class", "order", "family", "genus", "species"]
+
+    def __init__(self, taxTree=None):
+        self.taxTree = taxTree if taxTree is not None else TaxonomyTree()     # a built tree can be shared
         self.reads, self.genomes = [], []
         self.pi_list, self.delta_list = [], []
         self.a_list, self.b_list = [], []
-        self.q_list = []
+        self.q_list = []            # q of each alignment, non-aligned cells have q = 1
+        self.read_offsets = []      # alignments of read i are read_offsets[i]:read_offsets[i + 1]
+        self.genome_indices = []    # genome index of each alignment
         self.y_list = []
+        self.w_list = []            # number of reads in each row (equivalence class)
         self.groups = {}       # key - TI
         self.parentTIs = {}    # key - TI (get parent TI by organism TI)
-
-    def start(self, alignmentsFile):
-        taxTreeThread = Thread(target=self.taxTree.build)
-        taxTreeThread.start()
+        self.engine = "python"
+        self.compressReads = False
+        self.scoreStep = 0.001      # score quantization of equivalence classes
+        self.accelerated = False
+        self.processes = 1          # processes for parsing the alignments file
+        self.useCache = True        # keep parsed alignments in a binary cache next to the SAM file
+        self.iterations = 0         # EM steps of the last getResult
+        self.emTime = 0
+        self.pruneThreshold = 0     # genomes below this abundance are dropped from EM, 0 disables pruning
+        self.pruneIterations = 3    # for this many iterations in a row
+        self.belowThreshold = []    # iterations in a row below the threshold, by genome
+        self.prunedGenomes = {}     # key - TI, pi and delta when it was pruned
+        self.fullGenomes = None     # structures of all genomes while some are pruned
+        self.confidence = 0.95
+        self.intervals = {}         # key - TI, bootstrap percentile interval of the abundance
+        self.groupRank = None       # genomes are grouped by their ancestor at this rank, by parent if None
+
+    def start(self, alignmentsFile, engine="python", compressReads=False, accelerated=False, processes=1,
+              useCache=True, alignments=None, pruneThreshold=0, bootstrapReplicates=0, bootstrapTime=None,
+              groupRank=None, reportRanks=False):
+        self.engine = engine
+        self.groupRank = groupRank
+        self.pruneThreshold = pruneThreshold
+        self.compressReads = compressReads
+        self.accelerated = accelerated
+        self.processes = processes
+        self.useCache = useCache
+        taxTreeThread = Thread(target=self.taxTree.build if not self.taxTree.isBuilt() else None)
+        if self.processes <= 1:
+            taxTreeThread.start()
 
         # First substep
-        alignments = self.calculateInitialParameters(alignmentsFile)
-        result = self.getResult()
+        startTime = time()
+        with Metrics.stage("em_first_substep") as stage:
+            self.calculateInitialParameters(alignmentsFile, alignments)
+            if self.processes > 1:
+                # alignments are parsed in forked workers, so the taxonomy thread starts after them
+                taxTreeThread.start()
+            result = self.getResult()
+            stage.records = len(self.reads)
+        self.printTelemetry(time() - startTime)
         taxTreeThread.join()
         print("\nFirst result:\n")
         self.printResult(result)
         bestTIs = self.getBestTIsPerGroup(result)
 
         # Second substep
-        self.calculateInitialParameters(alignmentsFile, alignments, bestTIs)
-        result = self.getResult()
+        startTime = time()
+        with Metrics.stage("em_second_substep") as stage:
+            self.selectBestGenomes(bestTIs)
+            result = self.getResult()
+            stage.records = len(self.reads)
+        self.printTelemetry(time() - startTime)
+        if bootstrapReplicates > 0:
+            self.intervals = self.getBootstrapIntervals(bootstrapReplicates, bootstrapTime)
         print("\nFinal result:\n")
         self.printResult(result)
-
-    def calculateInitialParameters(self, alignmentsFile, alignments={}, bestTIs=[]):
-        IS_SECOND_STEP = bool(alignments)
-        self.reads, self.a_list, self.b_list, self.y_list = [], [], [], []
-        q_dict, map_freq, unique, non_unique = {}, {}, {}, {}
-        genomes = set()
+        if reportRanks:
+            self.printRankAbundances(self.getAbundancesByRank(result))
+        return result
+
+    def calculateInitialParameters(self, alignmentsFile, alignments=None):
+        self.reads, self.a_list, self.b_list, self.y_list, self.w_list = [], [], [], [], []
+        self.genomes, self.read_offsets, self.genome_indices = [], [0], []
+        map_freq, unique, non_unique = {}, {}, {}
+        genomeIndex, scores = {}, []
+        rows, classes = [], {}
         maxScore = 0
 
-        if not IS_SECOND_STEP:
-            print("\nSetting the initial parameters...")
-            with open(alignmentsFile) as alignFile:
-                for line in alignFile:
-                    if not line.startswith('@'):
-                        fields = line.strip().split("\t")
-                        QNAME = fields[0]
-                        RNAME = fields[2]  # reference marker gene
-
-                        if RNAME != "*":
-                            # calculate score
-                            CIGAR = fields[5]
-                            matches = n = 0
-                            num = ''
-                            for i in range(len(CIGAR)):
-                                c = CIGAR[i]
-                                if c.isdigit():
-                                    num += c
-                                else:
-                                    if c == 'M':
-                                        matches += int(num)
-                                    n += int(num)
-                                    num = ''
-                            score = n / matches
-
-                            TIs = RNAME.split("|")[3].split(",")
-                            alignments[QNAME] = TIs, score
-        else:
-            print("Resetting the parameters...")
+        print("\nSetting the initial parameters...")
+        if alignments is None:
+            alignments = self.loadAlignments(alignmentsFile)
 
-        for read in alignments:
-            self.reads.append(read)
-            TIs, score = alignments[read][0], alignments[read][1]
+        for read, (TIs, score) in alignments.items():
 
             if score > maxScore:
                 maxScore = score
 
-            if IS_SECOND_STEP:
-                TIsLeft = []
-                for TI in TIs:
-                    if TI in bestTIs:
-                        TIsLeft.append(TI)
-                TIs = TIsLeft
+            if self.compressReads:
+                # reads with the same TIs, uniqueness and quantized score share a row
+                key = tuple(sorted(TIs)), len(TIs) == 1, round(score / self.scoreStep)
+                equivalenceClass = classes.get(key, None)
+                if equivalenceClass is None:
+                    classes[key] = equivalenceClass = [read, TIs, 0, 0]
+                    rows.append(equivalenceClass)
+                equivalenceClass[2] += score
+                equivalenceClass[3] += 1
+            else:
+                rows.append((read, TIs, score, 1))
+
+        if self.compressReads:
+            print("\t\tReads: {}, equivalence classes: {}".format(len(alignments), len(rows)))
 
+        for read, TIs, score, weight in rows:
+            self.reads.append(read)
+            score /= weight
+            rowGenomes = set()
             for TI in TIs:
-                genomes.add(TI)
-                q_dict[read, TI] = score
-                map_freq[TI] = map_freq.get(TI, 0) + 1
+                j = genomeIndex.get(TI, None)
+                if j is None:
+                    j = genomeIndex[TI] = len(self.genomes)
+                    self.genomes.append(TI)
+
+                if j not in rowGenomes:
+                    rowGenomes.add(j)
+                    self.genome_indices.append(j)
+                    scores.append(score)
+                map_freq[TI] = map_freq.get(TI, 0) + weight
 
                 if len(TIs) == 1:
-                    unique[TI] = unique.get(TI, 0) + 1
+                    unique[TI] = unique.get(TI, 0) + weight
                 else:
-                    non_unique[TI] = non_unique.get(TI, 0) + 1
+                    non_unique[TI] = non_unique.get(TI, 0) + weight
 
+            self.read_offsets.append(len(self.genome_indices))
+            self.w_list.append(weight)
             if len(TIs) == 1:
                 self.y_list.append(1)
             else:
                 self.y_list.append(0)
 
-        self.genomes = list(genomes)
-        self.q_list = []
-        for i in range(len(self.reads)):
-            q_list_for_read = []
-            for j in range(len(self.genomes)):
-                q_list_for_read.append(math.exp(q_dict.get((self.reads[i], self.genomes[j]), 0) / maxScore))
-            self.q_list.append(q_list_for_read)
+        self.q_list = [math.exp(score / maxScore) for score in scores]
 
         self.pi_list, self.delta_list = [], []
         pi0 = delta0 = 1.0 / len(self.genomes)
@@ -123,18 +164,100 @@ class EMAlgorithm:
 
         return alignments
 
+    def selectBestGenomes(self, bestTIs):
+        # the second substep keeps the rows and q of the first one and drops the other genomes' columns,
+        # y and the a, b counts are recounted from the alignments that are left
+        print("Resetting the parameters...")
+        self.selectGenomes([j for j in range(len(self.genomes)) if self.genomes[j] in bestTIs])
+
+        self.y_list = [1 if self.read_offsets[i + 1] - self.read_offsets[i] == 1 else 0
+                       for i in range(len(self.reads))]
+        self.countPriors()
+
+        pi0 = delta0 = 1.0 / len(self.genomes)
+        self.pi_list = [pi0] * len(self.genomes)
+        self.delta_list = [delta0] * len(self.genomes)
+
+    def countPriors(self):
+        # a and b from the reads aligned to each genome, weighted by the rows' read counts
+        self.a_list, self.b_list = [0] * len(self.genomes), [0] * len(self.genomes)
+        for i in range(len(self.reads)):
+            unique_reads = self.w_list[i] * self.y_list[i]
+            for k in range(self.read_offsets[i], self.read_offsets[i + 1]):
+                j = self.genome_indices[k]
+                self.a_list[j] += self.w_list[i] + unique_reads
+                self.b_list[j] += 2 * self.w_list[i] - unique_reads
+
+    def getBootstrapIntervals(self, replicates, timeBudget=None):
+        # reads are resampled with replacement (as weights of the rows), every replicate starts
+        # from the full-data estimate; replicates still running when the time budget ends are dropped
+        global sharedEM
+
+        print("\nBootstrapping {} replicates...".format(replicates))
+        startTime = time()
+        samples = []
+        sharedEM = self
+        with Metrics.stage("bootstrap") as stage, get_context("fork").Pool(max(self.processes, 1)) as pool:
+            for sample in pool.imap_unordered(runBootstrapReplicate, range(replicates)):
+                samples.append(sample)
+                if timeBudget is not None and time() - startTime > timeBudget:
+                    break
+            stage.records = len(samples)
+        sharedEM = None
+
+        percent = 100 * (1 - self.confidence) / 2
+        low, high = np.percentile(np.asarray(samples), [percent, 100 - percent], axis=0)
+        print("\t\tReplicates: {}, time: {:.3f} s".format(len(samples), time() - startTime))
+        print("---Done.")
+        return dict((self.genomes[j], (low[j], high[j])) for j in range(len(self.genomes)))
+
+    def getBootstrapReplicate(self, seed):
+        # pool workers run many replicates, so the full-data weights, priors and estimate are restored after each
+        fullData = self.w_list, self.a_list, self.b_list, list(self.pi_list), list(self.delta_list)
+        try:
+            weights = np.asarray(self.w_list, dtype=np.float64)
+            self.w_list = np.random.RandomState(seed).multinomial(int(weights.sum()),
+                                                                  weights / weights.sum()).tolist()
+            self.countPriors()
+            self.getResult()
+
+            sum_pi = sum(self.pi_list)
+            return [pi / sum_pi for pi in self.pi_list]
+        finally:
+            self.w_list, self.a_list, self.b_list, self.pi_list, self.delta_list = fullData
+
+    def loadAlignments(self, alignmentsFile):
+        with Metrics.stage("alignments_load") as stage:
+            alignments = AlignmentsCache.load(alignmentsFile) if self.useCache else None
+            stage.values["cached"] = alignments is not None
+            if alignments is None:
+                alignments = SamParser.parseFile(alignmentsFile, {}, self.processes)
+                if self.useCache:
+                    AlignmentsCache.save(alignmentsFile, alignments)
+            else:
+                print("\t\tLoaded cached alignments")
+            stage.records = len(alignments)
+        return alignments
+
     def EStep(self):
         # expectation of parameters
-        h = [[0 for j in range(len(self.genomes))] for i in range(len(self.reads))]
-        h_sum = 0
+        # only aligned cells are stored, h holds their excess over the q = 1 background
+        weights = self.getGenomeWeights()
+        h = [0] * len(self.q_list)
+        h_sum = log_likelihood = 0
         for i in range(len(self.reads)):
-            for j in range(len(self.genomes)):
-                h[i][j] = self.pi_list[j] * pow(self.delta_list[j], 1 - self.y_list[i]) * self.q_list[i][j]
-                h_sum += h[i][j]
+            w, read_sum = weights[self.y_list[i]], weights[2 + self.y_list[i]]
+            for k in range(self.read_offsets[i], self.read_offsets[i + 1]):
+                h[k] = w[self.genome_indices[k]] * (self.q_list[k] - 1)
+                read_sum += h[k]
+                h[k] *= self.w_list[i]
+            h_sum += read_sum * self.w_list[i]
+            log_likelihood += self.w_list[i] * math.log(read_sum)
 
-        h = [[h[i][j] / h_sum for j in range(len(self.genomes))] for i in range(len(self.reads))]
+        h = [h_k / h_sum for h_k in h]
 
-        return h, h_sum
+        # the log-likelihood of the current parameters comes with the same sums
+        return h, h_sum, log_likelihood
 
     def MStep(self, h, N):
         # maximization of parameters
@@ -142,87 +265,292 @@ class EMAlgorithm:
         delta_list = list()
         a_sum = sum(self.a_list)
         b_sum = sum(self.b_list)
+        unique_sum = sum(self.w_list[i] * self.y_list[i] for i in range(len(self.reads)))
+        y_sum = sum(self.w_list) - unique_sum
 
-        for j in range(len(self.genomes)):
-            h_j_sum_by_reads = 0
-            h_j_with_y_sum_by_reads = 0
-            y_sum = 0
+        # background (q = 1) part of the sums by reads
+        h_sum_by_reads = [self.pi_list[j] * (unique_sum + y_sum * self.delta_list[j]) / N
+                          for j in range(len(self.genomes))]
+        h_with_y_sum_by_reads = [self.pi_list[j] * self.delta_list[j] * y_sum / N
+                                 for j in range(len(self.genomes))]
 
-            for i in range(len(self.reads)):
-                h_j_sum_by_reads += h[i][j]
-                h_j_with_y_sum_by_reads += h[i][j] * (1 - self.y_list[i])
-                y_sum += 1 - self.y_list[i]
+        for i in range(len(self.reads)):
+            non_unique = 1 - self.y_list[i]
+            for k in range(self.read_offsets[i], self.read_offsets[i + 1]):
+                j = self.genome_indices[k]
+                h_sum_by_reads[j] += h[k]
+                h_with_y_sum_by_reads[j] += h[k] * non_unique
 
-            pi = self.calculatePi(h_j_sum_by_reads, self.a_list[j], a_sum, N)
+        for j in range(len(self.genomes)):
+            pi = self.calculatePi(h_sum_by_reads[j], self.a_list[j], a_sum, N)
             pi_list.append(pi)
 
-            delta = self.calculateDelta(h_j_with_y_sum_by_reads, y_sum, self.b_list[j], b_sum)
+            delta = self.calculateDelta(h_with_y_sum_by_reads[j], y_sum, self.b_list[j], b_sum)
             delta_list.append(delta)
 
         return pi_list, delta_list
 
     def calculateLogLikelihood(self):
         log_likelihood = 0
+        weights = self.getGenomeWeights()
 
         for i in range(len(self.reads)):
-            inner_sum = 0
-            for j in range(len(self.genomes)):
-                inner_sum += self.pi_list[j] * (pow(self.delta_list[j], 1 - self.y_list[i]) * self.q_list[i][j])
-            log_likelihood += math.log(inner_sum)
+            w, inner_sum = weights[self.y_list[i]], weights[2 + self.y_list[i]]
+            for k in range(self.read_offsets[i], self.read_offsets[i + 1]):
+                inner_sum += w[self.genome_indices[k]] * (self.q_list[k] - 1)
+            log_likelihood += self.w_list[i] * math.log(inner_sum)
 
         return log_likelihood
 
+    def getGenomeWeights(self):
+        # pi * delta^(1 - y) for y = 0 and y = 1, followed by their sums over all genomes
+        non_unique = [self.pi_list[j] * self.delta_list[j] for j in range(len(self.genomes))]
+        return non_unique, self.pi_list, sum(non_unique), sum(self.pi_list)
+
     def getBestTIsPerGroup(self, result):
         print("\nGetting the best TIs per group...")
+        abundances = dict((TI, pi) for pi, TI in result)
+        groupTIs = [None] * len(self.genomes)
+        if self.groupRank is not None:
+            groupTIs = self.taxTree.getAncestorsAtRank(self.genomes, self.groupRank)
 
-        for TI in self.genomes:
-            genome = [r[0] for r in result if r[1] == TI][0], TI
-            parentTI = self.taxTree.taxNodes[TI].parent.taxId
+        for j in range(len(self.genomes)):
+            TI = self.genomes[j]
+            genome = abundances[TI], TI
+            # genomes without an ancestor at the group rank are grouped by their parent
+            parentTI = groupTIs[j] if groupTIs[j] is not None else self.taxTree.taxNodes[TI].parent.taxId
             groupGenome = self.groups.get(parentTI, (0, None))
 
             if genome[0] > groupGenome[0]:
                 self.groups[parentTI] = genome
                 self.parentTIs[TI] = parentTI
 
-        bestTIs = []
+        bestTIs = set()
         for group in self.groups:
-            bestTIs.append(self.groups[group][1])
+            bestTIs.add(self.groups[group][1])
 
         return bestTIs
 
     def getResult(self):
         EPSILON = pow(10, -8)
+        self.iterations = 0
+        self.belowThreshold = [0] * len(self.genomes)
+        self.prunedGenomes, self.fullGenomes = {}, None
+        initialParameters = list(self.pi_list), list(self.delta_list)
+        startTime = time()
+
+        with Metrics.stage("em") as stage:
+            self.runSelectedEM(EPSILON)
+            if self.fullGenomes is not None:
+                self.verifyPruning(EPSILON, initialParameters)
+            stage.records = len(self.reads)
+            stage.values.update(engine=self.engine, iterations=self.iterations, genomes=len(self.genomes),
+                                prunedGenomes=len(self.prunedGenomes))
+        self.emTime = time() - startTime
+
+        return self.getSolution()
+
+    def verifyPruning(self, EPSILON, initialParameters):
+        # EM over all genomes, started from the estimate without the pruned ones; the a/b priors pull
+        # the log-likelihood down at the fixed point, so pruning is checked by whether a pruned genome
+        # grows back above the threshold, in which case EM is run again over all genomes without pruning
+        self.restoreGenomes()
+        log_likelihood = self.getEngine().calculateLogLikelihood()
+        self.runSelectedEM(EPSILON, False)
+
+        threshold = self.pruneThreshold * sum(self.pi_list)
+        grown = [TI for TI, pi in zip(self.genomes, self.pi_list) if TI in self.prunedGenomes and pi >= threshold]
+        print("\t\tPruned genomes: {}, log-likelihood: {:.6f} after pruning, {:.6f} after the full pass".format(
+            len(self.prunedGenomes), log_likelihood, self.getEngine().calculateLogLikelihood()))
+
+        if grown:
+            print("\t\tWarning: {} pruned genomes grew back above the threshold, running EM without pruning".format(
+                len(grown)))
+            self.pi_list, self.delta_list = initialParameters
+            self.runSelectedEM(EPSILON, False)
+            self.prunedGenomes = {}
+
+    def runSelectedEM(self, EPSILON, prune=True):
+        if self.accelerated:
+            self.runAcceleratedEM(EPSILON, prune)
+        else:
+            self.runEM(EPSILON, prune)
+
+    def getEngine(self):
+        return NumpyEMEngine(self) if self.engine == "numpy" else self
+
+    def getSolution(self):
+        sum_pi = sum(self.pi_list)
+        solution = []
+        for i in range(len(self.genomes)):
+            solution.append((self.pi_list[i] / sum_pi, self.genomes[i]))
+
+        return sorted(solution, reverse=True)
+
+    def runEM(self, EPSILON, prune=False):
+        engine = self.getEngine()
         finished = False
         log_likelihood = None
 
         while not finished:
-            h, N = self.EStep()
-            new_pi_list, new_delta_list = self.MStep(h, N)
-            new_log_likelihood = self.calculateLogLikelihood()
+            h, N, new_log_likelihood = engine.EStep()
+            new_pi_list, new_delta_list = engine.MStep(h, N)
+            self.iterations += 1
 
-            convergency_of_log_likelihood = (log_likelihood is not None) and (abs(new_log_likelihood - log_likelihood) < EPSILON)
+            finished = self.hasConverged(new_pi_list, new_delta_list, log_likelihood, new_log_likelihood, EPSILON)
             log_likelihood = new_log_likelihood
-
-            # check if algorithm converges
-            finished = False
-            for i in range(len(self.pi_list)):
-                conv_pi = abs(new_pi_list[i] - self.pi_list[i]) < EPSILON
-                conv_delta = abs(new_delta_list[i] - self.delta_list[i]) < EPSILON
-                convergency_of_parameters = conv_pi and conv_delta
-
-                if convergency_of_parameters or convergency_of_log_likelihood:
-                    finished = True
-                    break
+            Metrics.record("em_iteration", iteration=self.iterations, logLikelihood=log_likelihood,
+                           genomes=len(self.genomes))
 
             if not finished:
                 self.pi_list, self.delta_list = new_pi_list, new_delta_list
+                if prune and self.pruneGenomes():
+                    engine = self.getEngine()
+                    log_likelihood = None
+
+    def runAcceleratedEM(self, EPSILON, prune=False):
+        # SQUAREM: extrapolate along two EM steps, the extrapolation is kept only
+        # if its log-likelihood is not lower than after the first EM step
+        MIN_PARAMETER = pow(10, -12)
+        engine = self.getEngine()
+        log_likelihood = None
+
+        while True:
+            G = len(self.genomes)
+            pi0, delta0 = self.pi_list, self.delta_list
+            h, N, log_likelihood0 = engine.EStep()
+            pi1, delta1 = engine.MStep(h, N)
+            self.iterations += 1
+
+            if self.hasConverged(pi1, delta1, log_likelihood, log_likelihood0, EPSILON):
+                break
+
+            self.pi_list, self.delta_list = pi1, delta1
+            h, N, log_likelihood1 = engine.EStep()
+            pi2, delta2 = engine.MStep(h, N)
+            self.iterations += 1
+
+            theta0, theta1, theta2 = pi0 + delta0, pi1 + delta1, pi2 + delta2
+            r = [theta1[k] - theta0[k] for k in range(2 * G)]
+            v = [theta2[k] - 2 * theta1[k] + theta0[k] for k in range(2 * G)]
+            r_norm, v_norm = sum(x * x for x in r), sum(x * x for x in v)
+            alpha = min(-math.sqrt(r_norm / v_norm), -1) if v_norm > 0 else -1
+
+            theta = [theta0[k] - 2 * alpha * r[k] + alpha * alpha * v[k] for k in range(2 * G)]
+            self.pi_list = [max(pi, MIN_PARAMETER) for pi in theta[:G]]
+            self.delta_list = [min(max(delta, MIN_PARAMETER), 1) for delta in theta[G:]]
+
+            h, N, log_likelihood = engine.EStep()
+            if log_likelihood >= log_likelihood1:
+                self.pi_list, self.delta_list = engine.MStep(h, N)
+                self.iterations += 1
+            else:
+                self.pi_list, self.delta_list = pi2, delta2
+                log_likelihood = log_likelihood1
+            Metrics.record("em_iteration", iteration=self.iterations, logLikelihood=log_likelihood,
+                           genomes=len(self.genomes), accelerated=True)
+
+            if prune and self.pruneGenomes():
+                engine = self.getEngine()
+                log_likelihood = None
+
+    def pruneGenomes(self):
+        # drops genomes whose abundance stayed below the threshold, returns True if any was dropped
+        if self.pruneThreshold <= 0:
+            return False
+
+        threshold = self.pruneThreshold * sum(self.pi_list)
+        kept = []
+        for j in range(len(self.genomes)):
+            self.belowThreshold[j] = self.belowThreshold[j] + 1 if self.pi_list[j] < threshold else 0
+            if self.belowThreshold[j] < self.pruneIterations:
+                kept.append(j)
+        if len(kept) == len(self.genomes) or not kept:
+            return False
+
+        if self.fullGenomes is None:
+            self.fullGenomes = self.genomes, self.a_list, self.b_list, self.q_list, self.read_offsets, \
+                self.genome_indices
+        keptSet = set(kept)
+        for j in range(len(self.genomes)):
+            if j not in keptSet:
+                self.prunedGenomes[self.genomes[j]] = self.pi_list[j], self.delta_list[j]
+
+        self.selectGenomes(kept)
+        self.belowThreshold = [self.belowThreshold[j] for j in kept]
+        return True
+
+    def selectGenomes(self, kept):
+        # keeps only the columns of the given genomes, reads keep their rows (and y) even if they become empty
+        newIndices = [-1] * len(self.genomes)
+        for n in range(len(kept)):
+            newIndices[kept[n]] = n
 
+        read_offsets, genome_indices, q_list = [0], [], []
+        for i in range(len(self.reads)):
+            for k in range(self.read_offsets[i], self.read_offsets[i + 1]):
+                j = newIndices[self.genome_indices[k]]
+                if j >= 0:
+                    genome_indices.append(j)
+                    q_list.append(self.q_list[k])
+            read_offsets.append(len(genome_indices))
+
+        self.read_offsets, self.genome_indices, self.q_list = read_offsets, genome_indices, q_list
+        self.genomes = [self.genomes[j] for j in kept]
+        self.pi_list = [self.pi_list[j] for j in kept]
+        self.delta_list = [self.delta_list[j] for j in kept]
+        self.a_list = [self.a_list[j] for j in kept]
+        self.b_list = [self.b_list[j] for j in kept]
+
+    def restoreGenomes(self):
+        # pruned genomes get back the parameters they were pruned with, pi keeps its sum
+        parameters = dict(zip(self.genomes, zip(self.pi_list, self.delta_list)))
+        parameters.update(self.prunedGenomes)
         sum_pi = sum(self.pi_list)
-        solution = []
-        for i in range(len(self.genomes)):
-            solution.append((self.pi_list[i] / sum_pi, self.genomes[i]))
 
-        return sorted(solution, reverse=True)
+        self.genomes, self.a_list, self.b_list, self.q_list, self.read_offsets, self.genome_indices = self.fullGenomes
+        scale = sum_pi / sum(parameters[TI][0] for TI in self.genomes)
+        self.pi_list = [parameters[TI][0] * scale for TI in self.genomes]
+        self.delta_list = [parameters[TI][1] for TI in self.genomes]
+        self.fullGenomes = None
+
+    def hasConverged(self, new_pi_list, new_delta_list, log_likelihood, new_log_likelihood, EPSILON):
+        convergency_of_log_likelihood = (log_likelihood is not None) and (abs(new_log_likelihood - log_likelihood) < EPSILON)
+
+        # check if algorithm converges
+        for i in range(len(self.pi_list)):
+            conv_pi = abs(new_pi_list[i] - self.pi_list[i]) < EPSILON
+            conv_delta = abs(new_delta_list[i] - self.delta_list[i]) < EPSILON
+            convergency_of_parameters = conv_pi and conv_delta
+
+            if convergency_of_parameters or convergency_of_log_likelihood:
+                return True
+
+        return False
+
+    def getAbundancesByRank(self, result, ranks=None):
+        # abundances summed by the ancestor at each rank, genomes without one are left out
+        TIs = [TI for pi, TI in result]
+        abundancesByRank = {}
+
+        for rank in ranks or EMAlgorithm.MAJOR_RANKS:
+            abundances = {}
+            for (pi, TI), ancestorTI in zip(result, self.taxTree.getAncestorsAtRank(TIs, rank)):
+                if ancestorTI is not None:
+                    abundances[ancestorTI] = abundances.get(ancestorTI, 0) + pi
+            abundancesByRank[rank] = sorted(((pi, TI) for TI, pi in abundances.items()), reverse=True)
+
+        return abundancesByRank
+
+    def printRankAbundances(self, abundancesByRank):
+        N = 5
+        for rank in EMAlgorithm.MAJOR_RANKS:
+            if not abundancesByRank.get(rank, None):
+                continue
+            print("\nBy {}:\n".format(rank))
+            for i, (pi, TI) in enumerate(abundancesByRank[rank][:N]):
+                print("{}. {}".format(i + 1, self.taxTree.taxonomyNames.get(TI, None)))
+                print("     {:10}  {:>.8}".format(TI, pi))
 
     def printResult(self, result):
         N = 5
@@ -236,10 +564,18 @@ class EMAlgorithm:
 
         for i in range(N):
             print("{}. {}".format(i + 1, names[i]))
-            print("     {:10}  {:>.8}".format(result[i][1], result[i][0]))
+            interval = self.intervals.get(result[i][1], None)
+            if interval is None:
+                print("     {:10}  {:>.8}".format(result[i][1], result[i][0]))
+            else:
+                print("     {:10}  {:>.8}  [{:.8f}, {:.8f}]".format(result[i][1], result[i][0], *interval))
 
         return TIs
 
+    def printTelemetry(self, substepTime):
+        print("\t\tEM steps: {}, EM time: {:.3f} s, substep time: {:.3f} s".format(
+            self.iterations, self.emTime, substepTime))
+
     @staticmethod
     def calculatePi(h_j_sum_by_R, a_j, a_sum, N):
         return (h_j_sum_by_R + a_j) / (N + a_sum)
@@ -247,3 +583,11 @@ class EMAlgorithm:
     @staticmethod
     def calculateDelta(h_j_with_y_sum_by_R, y_sum, b_j, b_sum):
         return (h_j_with_y_sum_by_R + b_j) / (y_sum + b_sum)
+
+
+# set before the bootstrap pool is forked, every worker resamples its own copy
+sharedEM = None
+
+
+def runBootstrapReplicate(seed):
+    return sharedEM.getBootstrapReplicate(seed)
@@ -0,0 +1,146 @@
+import math
+from EMAlgorithm import EMAlgorithm
+
+
+class IncrementalEMAlgorithm(EMAlgorithm):
+    # EM over alignments that arrive in batches: each batch updates the counts and the
+    # sums over reads in place and runs EM steps over its own reads only, starting from
+    # the previous pi/delta; sums of earlier reads are kept from the parameters they were last computed with
+    def __init__(self, taxTree=None):
+        EMAlgorithm.__init__(self, taxTree)
+        self.read_offsets = [0]
+        self.score_list = []        # score of each alignment, q is recomputed if the max score grows
+        self.maxScore = 0
+        self.genomeIndex = {}       # key - TI
+        self.seenReads = set()
+        self.unique_sum, self.y_sum = 0, 0
+        self.excess_list, self.excess_with_y_list = [], []     # sums of h over aligned cells by genome
+        self.batches = 0
+        self.maxIterations = 100
+
+    def addBatch(self, alignments):
+        firstRead, maxScoreChanged = len(self.reads), False
+
+        for read, (TIs, score) in alignments.items():
+            # a read seen in an earlier batch keeps its first alignment
+            if read in self.seenReads:
+                continue
+            self.seenReads.add(read)
+            self.reads.append(read)
+
+            if score > self.maxScore:
+                self.maxScore, maxScoreChanged = score, True
+
+            y = 1 if len(TIs) == 1 else 0
+            rowGenomes = set()
+            for TI in TIs:
+                j = self.genomeIndex.get(TI, None)
+                if j is None:
+                    j = self.addGenome(TI)
+
+                if j not in rowGenomes:
+                    rowGenomes.add(j)
+                    self.genome_indices.append(j)
+                    self.score_list.append(score)
+                self.a_list[j] += 1 + y
+                self.b_list[j] += 2 - y
+
+            self.read_offsets.append(len(self.genome_indices))
+            self.y_list.append(y)
+            self.w_list.append(1)
+            self.unique_sum += y
+            self.y_sum += 1 - y
+
+        self.batches += 1
+        if maxScoreChanged:
+            # every q depends on the max score, so the sums over earlier reads are recomputed,
+            # the batch's own reads are added by runBatchEM
+            self.q_list = [math.exp(score / self.maxScore) for score in self.score_list]
+            self.excess_list = [0] * len(self.genomes)
+            self.excess_with_y_list = [0] * len(self.genomes)
+            self.addReadSums(0, firstRead, 1)
+        else:
+            self.q_list.extend(math.exp(score / self.maxScore) for score in self.score_list[len(self.q_list):])
+
+        self.runBatchEM(firstRead)
+        return self.getSolution()
+
+    def addGenome(self, TI):
+        j = self.genomeIndex[TI] = len(self.genomes)
+        self.genomes.append(TI)
+        pi0 = delta0 = 1.0 / len(self.genomes)
+        self.pi_list.append(pi0)
+        self.delta_list.append(delta0)
+        self.a_list.append(0)
+        self.b_list.append(0)
+        self.excess_list.append(0)
+        self.excess_with_y_list.append(0)
+        return j
+
+    def runBatchEM(self, firstRead):
+        EPSILON = pow(10, -8)
+        log_likelihood = None
+        batchSums = None
+        self.iterations = 0
+
+        while self.iterations < self.maxIterations:
+            # replace the batch's previous contribution with one from the current parameters
+            if batchSums is not None:
+                self.addReadSums(firstRead, len(self.reads), -1, batchSums)
+            batchSums = self.addReadSums(firstRead, len(self.reads), 1)
+            new_pi_list, new_delta_list = self.getParametersFromSums()
+            self.iterations += 1
+
+            finished = self.hasConverged(new_pi_list, new_delta_list, log_likelihood, batchSums[2], EPSILON)
+            log_likelihood = batchSums[2]
+            if finished:
+                break
+            self.pi_list, self.delta_list = new_pi_list, new_delta_list
+
+    def addReadSums(self, firstRead, lastRead, sign, readSums=None):
+        # adds h of aligned cells of the reads to the sums by genome, returns what was added
+        if readSums is not None:
+            excess, excess_with_y, log_likelihood = readSums
+        else:
+            weights = self.getGenomeWeights()
+            excess, excess_with_y, log_likelihood = {}, {}, 0
+            for i in range(firstRead, lastRead):
+                w, read_sum = weights[self.y_list[i]], weights[2 + self.y_list[i]]
+                for k in range(self.read_offsets[i], self.read_offsets[i + 1]):
+                    j = self.genome_indices[k]
+                    h = w[j] * (self.q_list[k] - 1) * self.w_list[i]
+                    read_sum += h / self.w_list[i]
+                    excess[j] = excess.get(j, 0) + h
+                    if self.y_list[i] == 0:
+                        excess_with_y[j] = excess_with_y.get(j, 0) + h
+                log_likelihood += self.w_list[i] * math.log(read_sum)
+
+        for j in excess:
+            self.excess_list[j] += sign * excess[j]
+        for j in excess_with_y:
+            self.excess_with_y_list[j] += sign * excess_with_y[j]
+        return excess, excess_with_y, log_likelihood
+
+    def getParametersFromSums(self):
+        # MStep from the kept sums, the q = 1 background of all reads is exact for the current parameters
+        G = len(self.genomes)
+        weights = self.getGenomeWeights()
+        N = self.y_sum * weights[2] + self.unique_sum * weights[3] + sum(self.excess_list)
+        a_sum, b_sum = sum(self.a_list), sum(self.b_list)
+
+        pi_list, delta_list = [], []
+        for j in range(G):
+            h_sum_by_reads = (self.pi_list[j] * (self.unique_sum + self.y_sum * self.delta_list[j]) + self.excess_list[j]) / N
+            h_with_y_sum_by_reads = (self.pi_list[j] * self.delta_list[j] * self.y_sum + self.excess_with_y_list[j]) / N
+            pi_list.append(self.calculatePi(h_sum_by_reads, self.a_list[j], a_sum, N))
+            delta_list.append(self.calculateDelta(h_with_y_sum_by_reads, self.y_sum, self.b_list[j], b_sum))
+
+        return pi_list, delta_list
+
+    def refine(self):
+        # full EM over all reads, warm-started from the current estimate
+        result = self.getResult()
+        self.excess_list = [0] * len(self.genomes)
+        self.excess_with_y_list = [0] * len(self.genomes)
+        self.addReadSums(0, len(self.reads), 1)
+        return result
@@ -0,0 +1,80 @@
+import cProfile
+import json
+import resource
+from os import getpid
+from threading import local
+from time import process_time, time
+
+
+class Metrics:
+    # process-wide JSON-lines metrics, disabled until an output file is set;
+    # forked workers inherit the file and append their own lines
+    output = None
+    profilePrefix = None    # a cProfile dump of each stage is written to <prefix>.<stage>.prof
+    profiling = local()     # only the outermost stage of each thread is profiled
+
+    @staticmethod
+    def configure(outputFile, profilePrefix=None):
+        Metrics.close()
+        Metrics.output = open(outputFile, 'a')
+        Metrics.profilePrefix = profilePrefix
+
+    @staticmethod
+    def close():
+        if Metrics.output is not None:
+            Metrics.output.close()
+        Metrics.output, Metrics.profilePrefix = None, None
+
+    @staticmethod
+    def isEnabled():
+        return Metrics.output is not None
+
+    @staticmethod
+    def record(event, **values):
+        if Metrics.output is None:
+            return
+        values["event"], values["pid"], values["timestamp"] = event, getpid(), time()
+        Metrics.output.write(json.dumps(values, sort_keys=True) + "\n")
+        Metrics.output.flush()
+
+    @staticmethod
+    def stage(name):
+        return StageMetrics(name)
+
+    @staticmethod
+    def getPeakRSS():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss     # KiB on Linux
+
+
+class StageMetrics:
+    # with Metrics.stage("name") as stage: ... stage.records += n
+    def __init__(self, name):
+        self.name = name
+        self.records = 0
+        self.values = {}        # extra values recorded with the stage
+        self.profile = None
+        self.startTime = self.startCpuTime = 0
+
+    def __enter__(self):
+        if Metrics.profilePrefix is not None and not getattr(Metrics.profiling, "active", False):
+            self.profile = cProfile.Profile()
+            try:
+                self.profile.enable()
+                Metrics.profiling.active = True
+            except ValueError:
+                # newer Pythons allow only one active profiler per process
+                self.profile = None
+        self.startTime, self.startCpuTime = time(), process_time()
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        wallTime, cpuTime = time() - self.startTime, process_time() - self.startCpuTime
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats("{}.{}.prof".format(Metrics.profilePrefix, self.name))
+            Metrics.profiling.active = False
+
+        Metrics.record("stage", stage=self.name, time=wallTime, cpuTime=cpuTime, peakRSS=Metrics.getPeakRSS(),
+                       records=self.records, throughput=self.records / wallTime if wallTime > 0 else 0,
+                       failed=exceptionType is not None, **self.values)
+        return False
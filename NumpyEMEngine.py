@@ -0,0 +1,57 @@
+import numpy as np
+
+
+class NumpyEMEngine:
+    def __init__(self, em):
+        self.em = em
+        self.readsCount, self.genomesCount = len(em.reads), len(em.genomes)
+
+        offsets = np.asarray(em.read_offsets, dtype=np.intp)
+        self.readIndices = np.repeat(np.arange(self.readsCount), np.diff(offsets))
+        self.genomeIndices = np.asarray(em.genome_indices, dtype=np.intp)
+        self.q_excess = np.asarray(em.q_list, dtype=np.float64) - 1
+
+        self.y = np.asarray(em.y_list, dtype=np.float64)
+        self.w = np.asarray(em.w_list, dtype=np.float64)
+        self.alignmentNonUnique = 1 - self.y[self.readIndices]
+        self.alignmentWeights = self.w[self.readIndices]
+        self.unique_sum = np.dot(self.w, self.y)
+        self.y_sum = self.w.sum() - self.unique_sum
+
+        self.a, self.b = np.asarray(em.a_list, dtype=np.float64), np.asarray(em.b_list, dtype=np.float64)
+        self.a_sum, self.b_sum = self.a.sum(), self.b.sum()
+
+    def getParameters(self):
+        return np.asarray(self.em.pi_list, dtype=np.float64), np.asarray(self.em.delta_list, dtype=np.float64)
+
+    def getReadSums(self):
+        # h of aligned cells (excess over the q = 1 background) and sum of h per read
+        pi, delta = self.getParameters()
+        pi_a, delta_a = pi[self.genomeIndices], delta[self.genomeIndices]
+        h = pi_a * np.power(delta_a, self.alignmentNonUnique) * self.q_excess
+
+        background = np.where(self.y == 1, pi.sum(), np.dot(pi, delta))
+        read_sums = background + np.bincount(self.readIndices, weights=h, minlength=self.readsCount)
+        return h, read_sums
+
+    def EStep(self):
+        h, read_sums = self.getReadSums()
+        h_sum = np.dot(self.w, read_sums)
+        log_likelihood = float(np.dot(self.w, np.log(read_sums)))
+        return h * self.alignmentWeights / h_sum, h_sum, log_likelihood
+
+    def MStep(self, h, N):
+        pi, delta = self.getParameters()
+
+        h_sum_by_reads = pi * (self.unique_sum + self.y_sum * delta) / N
+        h_sum_by_reads += np.bincount(self.genomeIndices, weights=h, minlength=self.genomesCount)
+        h_with_y_sum_by_reads = pi * delta * self.y_sum / N
+        h_with_y_sum_by_reads += np.bincount(self.genomeIndices, weights=h * self.alignmentNonUnique,
+                                             minlength=self.genomesCount)
+
+        pi_list = self.em.calculatePi(h_sum_by_reads, self.a, self.a_sum, N)
+        delta_list = self.em.calculateDelta(h_with_y_sum_by_reads, self.y_sum, self.b, self.b_sum)
+        return pi_list.tolist(), delta_list.tolist()
+
+    def calculateLogLikelihood(self):
+        return float(np.dot(self.w, np.log(self.getReadSums()[1])))
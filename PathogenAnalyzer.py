@@ -1,28 +1,159 @@
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from os import system
-from sys import argv, exit
+from os import remove, replace
+from subprocess import PIPE, Popen, call
+from sys import exit
+from time import time
 from EMAlgorithm import EMAlgorithm
+from IncrementalEMAlgorithm import IncrementalEMAlgorithm
 from DatabaseReducer import DatabaseReducer
+from SamParser import SamParser
+from AlignmentsCache import AlignmentsCache
+from Metrics import Metrics
 from res.ResourceFiles import REDUCED_DB_FILE
 
 
 def main():
-    try:
-        INPUT_FILE = str(argv[1])
-    except:
-        print("Missing argument: input file")
-        exit(1)
+    parser = ArgumentParser()
+    parser.add_argument("input", help="input file with reads")
+    parser.add_argument("--engine", choices=["python", "numpy"], default="python",
+                        help="implementation of the EM steps")
+    parser.add_argument("--compress", action="store_true",
+                        help="collapse reads into equivalence classes before EM")
+    parser.add_argument("--accelerated", action="store_true",
+                        help="use SQUAREM extrapolation between EM steps")
+    parser.add_argument("--prune", type=float, default=0,
+                        help="drop genomes below this relative abundance from EM iterations, a final pass over "
+                             "all genomes reruns EM without pruning if a pruned genome grows back")
+    parser.add_argument("--bootstrap", type=int, default=0,
+                        help="bootstrap replicates for confidence intervals of the final abundances")
+    parser.add_argument("--bootstrap-time", type=float, default=None,
+                        help="stop bootstrapping after this many seconds")
+    parser.add_argument("--group-rank", default=None,
+                        help="keep the best genome per ancestor at this rank for the second substep (default: parent)")
+    parser.add_argument("--by-rank", action="store_true",
+                        help="also report the final abundances summed at every major rank")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="processes for parsing the alignments and markers files and for bootstrap replicates")
+    parser.add_argument("--no-cache", dest="cache", action="store_false",
+                        help="do not read or write the binary alignments cache")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="build the reduced database again even if it was built without checkpoints")
+    parser.add_argument("--streaming-pairing", action="store_true",
+                        help="pair markers through sorted runs on disk when the reduced database is built")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="split the reduced database and map against the shards concurrently")
+    parser.add_argument("--aligner", default="graphmap",
+                        help="aligner executable, called as: ALIGNER align -r DATABASE -d READS -o SAM")
+    parser.add_argument("--stream", action="store_true",
+                        help="parse the aligner output while mapping runs (without --shards)")
+    parser.add_argument("--batch-size", type=int, default=0,
+                        help="with --stream, update the estimate after every BATCH_SIZE reads")
+    parser.add_argument("--metrics", default=None,
+                        help="append JSON lines with time, CPU, peak memory and EM traces of every stage")
+    parser.add_argument("--profile", action="store_true",
+                        help="with --metrics, also write a cProfile dump of every stage to METRICS.<stage>.prof")
+    args = parser.parse_args()
+    INPUT_FILE = args.input
 
-    if not Path(REDUCED_DB_FILE).is_file():
-        DatabaseReducer().generate()
+    if args.metrics is not None:
+        Metrics.configure(args.metrics, args.metrics if args.profile else None)
+        Metrics.record("run", arguments=vars(args))
 
-    OUTPUT_FILE_NAME = ''.join(INPUT_FILE.split('/')[-1].split('.')[:-1]) + ".sam"
-    ALIGNMENTS_FILE = "alignments/out/" + OUTPUT_FILE_NAME
+    DatabaseReducer(args.processes, args.streaming_pairing, args.shards, args.rebuild).generate()
 
+    ALIGNMENTS_FILE = getAlignmentsFile(INPUT_FILE)
+
+    alignments = None
     if not Path(ALIGNMENTS_FILE).is_file():
-        system("graphmap align -r " + "./" + REDUCED_DB_FILE + " -d " + INPUT_FILE + " -o " + "./" + ALIGNMENTS_FILE)
+        with Metrics.stage("mapping") as stage:
+            if args.stream and args.shards <= 1:
+                alignments = mapReadsStreaming(args.aligner, REDUCED_DB_FILE, INPUT_FILE, ALIGNMENTS_FILE,
+                                               args.batch_size)
+                mapped = alignments is not None
+                if mapped:
+                    stage.records = len(alignments)
+                    if args.cache:
+                        AlignmentsCache.save(ALIGNMENTS_FILE, alignments)
+            elif args.shards > 1:
+                shardFiles = DatabaseReducer.getShardFiles(REDUCED_DB_FILE, args.shards)
+                mapped = mapReadsToShards(args.aligner, shardFiles, INPUT_FILE, ALIGNMENTS_FILE)
+            else:
+                mapped = mapReads(args.aligner, REDUCED_DB_FILE, INPUT_FILE, ALIGNMENTS_FILE) == 0
+        if not mapped:
+            print("Mapping failed.")
+            exit(1)
+
+    EMAlgorithm().start(ALIGNMENTS_FILE, args.engine, args.compress, args.accelerated, args.processes,
+                        args.cache, alignments, args.prune, args.bootstrap, args.bootstrap_time,
+                        args.group_rank, args.by_rank)
+
+
+def getAlignmentsFile(inputFile):
+    return "alignments/out/" + getSampleName(inputFile) + ".sam"
+
+
+def getSampleName(inputFile):
+    return ''.join(inputFile.split('/')[-1].split('.')[:-1])
+
+
+def getAlignerCommand(aligner, database, inputFile, alignmentsFile):
+    return [aligner, "align", "-r", database, "-d", inputFile, "-o", alignmentsFile]
+
+
+def mapReads(aligner, database, inputFile, alignmentsFile):
+    return call(getAlignerCommand(aligner, database, inputFile, alignmentsFile))
+
+
+def mapReadsStreaming(aligner, database, inputFile, alignmentsFile, batchSize=0):
+    # alignments are parsed from the aligner output while it runs, the SAM file is kept for later runs
+    partialFile = alignmentsFile + ".part"
+    process = Popen(getAlignerCommand(aligner, database, inputFile, "/dev/stdout"), stdout=PIPE)
+    onBatch = None
+    if batchSize > 0:
+        onBatch = BatchMonitor().update
+
+    with open(partialFile, 'wb') as sideOutput:
+        alignments = SamParser.parseStream(process.stdout, {}, sideOutput, onBatch, max(batchSize, 1))
+    if process.wait() != 0:
+        remove(partialFile)
+        return None
+
+    replace(partialFile, alignmentsFile)
+    return alignments
+
+
+class BatchMonitor:
+    # prints the estimate after every batch of streamed alignments
+    def __init__(self):
+        self.em = IncrementalEMAlgorithm()
+        self.reads = 0
+
+    def update(self, batch):
+        startTime = time()
+        result = self.em.addBatch(batch)
+        self.reads += len(batch)
+        print("\nBatch {}: {} reads\t\t{} EM steps\t\t{:.3f} s\n".format(self.em.batches, self.reads,
+                                                                           self.em.iterations, time() - startTime))
+        for pi, TI in result[:5]:
+            print("\t\t{}\t{:.6f}".format(TI, pi))
+
+
+def mapReadsToShards(aligner, shardFiles, inputFile, alignmentsFile):
+    shardAlignmentsFiles = ["{}.shard{}.sam".format(alignmentsFile, shard) for shard in range(len(shardFiles))]
+
+    with ThreadPoolExecutor(max_workers=len(shardFiles)) as pool:
+        returnCodes = list(pool.map(lambda shard: mapReads(aligner, shardFiles[shard], inputFile,
+                                                           shardAlignmentsFiles[shard]), range(len(shardFiles))))
+
+    if any(returnCode != 0 for returnCode in returnCodes):
+        return False
 
-    EMAlgorithm().start(ALIGNMENTS_FILE)
+    SamParser.mergeFiles(shardAlignmentsFiles, alignmentsFile)
+    for shardAlignmentsFile in shardAlignmentsFiles:
+        remove(shardAlignmentsFile)
+    return True
 
 
 if __name__ == "__main__":
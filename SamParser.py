@@ -0,0 +1,139 @@
+import re
+from os.path import getsize
+from multiprocessing import get_context
+
+
+class SamParser:
+    CIGAR_LENGTH = re.compile(br"\d+")
+    CIGAR_MATCH_LENGTH = re.compile(br"(\d+)M")
+    MIN_CHUNK_SIZE = 1 << 20
+
+    @staticmethod
+    def parseFile(alignmentsFile, alignments, processes=1):
+        size = getsize(alignmentsFile)
+        chunksCount = min(processes * 4, size // SamParser.MIN_CHUNK_SIZE)
+
+        if processes <= 1 or chunksCount <= 1:
+            alignments.update(SamParser.parseChunk((alignmentsFile, 0, size)))
+            return alignments
+
+        chunks = [(alignmentsFile, start, end) for start, end in SamParser.splitFile(alignmentsFile, chunksCount)]
+        with get_context("fork").Pool(processes) as pool:
+            # chunks are merged in file order, so a later alignment of the same read still wins
+            for chunkAlignments in pool.imap(SamParser.parseChunk, chunks):
+                alignments.update(chunkAlignments)
+
+        return alignments
+
+    @staticmethod
+    def parseStream(lines, alignments, sideOutput, onBatch=None, batchSize=10000):
+        # lines are parsed as they arrive and also copied to the side output,
+        # every batchSize reads are passed to onBatch (lines of one read are kept in the same batch)
+        batch = {}
+        for line in lines:
+            sideOutput.write(line)
+            if onBatch is not None and len(batch) >= batchSize and not line.startswith(b'@') \
+                    and line.split(b"\t", 1)[0].decode() not in batch:
+                alignments.update(batch)
+                onBatch(batch)
+                batch = {}
+            SamParser.parseLine(line, batch)
+
+        alignments.update(batch)
+        if onBatch is not None and batch:
+            onBatch(batch)
+        return alignments
+
+    @staticmethod
+    def splitFile(alignmentsFile, chunksCount):
+        size = getsize(alignmentsFile)
+        offsets = [0]
+
+        with open(alignmentsFile, 'rb') as alignFile:
+            for i in range(1, chunksCount):
+                alignFile.seek(max(size * i // chunksCount - 1, offsets[-1]))
+                alignFile.readline()
+                offsets.append(alignFile.tell())
+        offsets.append(size)
+
+        return [(offsets[i], offsets[i + 1]) for i in range(chunksCount) if offsets[i] < offsets[i + 1]]
+
+    @staticmethod
+    def parseChunk(chunk):
+        alignmentsFile, start, end = chunk
+        alignments = {}
+
+        with open(alignmentsFile, 'rb') as alignFile:
+            alignFile.seek(start)
+            position = start
+            for line in alignFile:
+                position += len(line)
+                SamParser.parseLine(line, alignments)
+                if position >= end:
+                    break
+
+        return alignments
+
+    @staticmethod
+    def parseLine(line, alignments):
+        if not line.startswith(b'@'):
+            fields = line.split(b"\t", 6)
+            RNAME = fields[2]  # reference marker gene
+
+            if RNAME != b"*":
+                TIs = RNAME.split(b"|")[3].decode().split(",")
+                alignments[fields[0].decode()] = TIs, SamParser.getScore(fields[5])
+
+    @staticmethod
+    def getScore(CIGAR):
+        n = sum(map(int, SamParser.CIGAR_LENGTH.findall(CIGAR)))
+        matches = sum(map(int, SamParser.CIGAR_MATCH_LENGTH.findall(CIGAR)))
+        return n / matches
+
+    @staticmethod
+    def mergeFiles(samFiles, outputFile):
+        # keeps the best alignment of every read: mapped first, then by AS:i tag, then by matched bases
+        best = {}
+        headers, references = [], []
+        for fileIndex in range(len(samFiles)):
+            with open(samFiles[fileIndex], 'rb') as samFile:
+                for lineIndex, line in enumerate(samFile):
+                    if line.startswith(b'@'):
+                        if line.startswith(b'@SQ'):
+                            references.append(line)
+                        elif fileIndex == 0:
+                            headers.append(line)
+                        continue
+
+                    fields = line.split(b"\t")
+                    rank = SamParser.getAlignmentRank(fields)
+                    current = best.get(fields[0], None)
+                    if current is None or rank > current[0]:
+                        best[fields[0]] = rank, fileIndex, lineIndex
+
+        chosenLines = [set() for samFile in samFiles]
+        for rank, fileIndex, lineIndex in best.values():
+            chosenLines[fileIndex].add(lineIndex)
+        best.clear()
+
+        with open(outputFile, 'wb') as output:
+            output.writelines(line for line in headers if line.startswith(b'@HD'))
+            output.writelines(references)
+            output.writelines(line for line in headers if not line.startswith(b'@HD'))
+            for fileIndex in range(len(samFiles)):
+                with open(samFiles[fileIndex], 'rb') as samFile:
+                    for lineIndex, line in enumerate(samFile):
+                        if lineIndex in chosenLines[fileIndex]:
+                            output.write(line)
+
+    @staticmethod
+    def getAlignmentRank(fields):
+        if fields[2] == b"*":
+            return 0, 0, 0
+
+        alignmentScore = 0
+        for field in fields[11:]:
+            if field.startswith(b"AS:i:"):
+                alignmentScore = int(field[5:])
+        matches = sum(map(int, SamParser.CIGAR_MATCH_LENGTH.findall(fields[5])))
+        return 1, alignmentScore, matches
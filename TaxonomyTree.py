@@ -1,19 +1,64 @@
+import numpy as np
 from re import sub
 from res.ResourceFiles import NAMES_FILE, NODES_FILE, NODES_STATS_FILE
 from TaxonomyTreeNode import TaxonomyTreeNode
+from Metrics import Metrics
+from CompactTaxonomy import CompactTaxonomy, CompactTaxonomyNames, CompactTaxonomyIDs, CompactTaxonomyNodes
 
 
 class TaxonomyTree:
-    def __init__(self, databaseMode=False):
+    def __init__(self, databaseMode=False, compact=True, useSnapshot=True):
         self.databaseMode = databaseMode
+        self.compact = compact          # keep the tree in CompactTaxonomy arrays instead of node objects
+        self.useSnapshot = useSnapshot  # save compact arrays next to the dump files and reuse them
         self.taxonomyNames = {}     # key = TI
         self.taxIDFromName = {}     # key = taxName
         self.taxNodes = {}          # key = taxName
+        self.compactTaxonomy = None
+        self.speciesIndex = None    # preorder ranges of nodes and sorted preorder numbers of species
+        self.speciesCache = {}      # key = TI
+        self.rankAncestors = {}     # key = rank, index of the closest ancestor at the rank by node
 
     def build(self):
         printInfo = self.databaseMode
-        self.parseTaxonomyNamesFile(NAMES_FILE, printInfo)
-        self.parseTaxonomyNodesFile(NODES_FILE, printInfo)
+        with Metrics.stage("taxonomy_build") as stage:
+            if self.compact:
+                self.buildCompact(printInfo)
+                stage.records = len(self.compactTaxonomy.taxIds)
+            else:
+                self.parseTaxonomyNamesFile(NAMES_FILE, printInfo)
+                self.parseTaxonomyNodesFile(NODES_FILE, printInfo)
+                stage.records = len(self.taxNodes)
+
+    def isBuilt(self):
+        return self.compactTaxonomy is not None or len(self.taxNodes) > 0
+
+    def buildCompact(self, printInfo):
+        snapshotDirectory = self.getSnapshotDirectory()
+
+        if self.useSnapshot and CompactTaxonomy.isSnapshotValid(snapshotDirectory, [NAMES_FILE, NODES_FILE]):
+            self.setCompactTaxonomy(CompactTaxonomy.load(snapshotDirectory))
+            return
+
+        taxonomy = CompactTaxonomy.fromDumps(NAMES_FILE, NODES_FILE, self.databaseMode, printInfo)
+        if self.useSnapshot:
+            try:
+                taxonomy.save(snapshotDirectory, [NAMES_FILE, NODES_FILE])
+            except OSError as error:
+                # e.g. a read-only dumps directory, the taxonomy is used from memory
+                print("\t\tTaxonomy snapshot not saved: {}".format(error))
+        self.setCompactTaxonomy(taxonomy)
+
+    def getSnapshotDirectory(self):
+        # names are stored differently in database mode
+        return NODES_FILE + (".db" if self.databaseMode else "") + ".snapshot"
+
+    def setCompactTaxonomy(self, taxonomy):
+        self.compactTaxonomy = taxonomy
+        self.clearAncestorIndex()
+        self.taxonomyNames = CompactTaxonomyNames(taxonomy)
+        self.taxIDFromName = CompactTaxonomyIDs(taxonomy)
+        self.taxNodes = CompactTaxonomyNodes(taxonomy)
 
     def parseTaxonomyNamesFile(self, taxonomyNamesFile, printInfo):
         if printInfo:
@@ -69,6 +114,69 @@ class TaxonomyTree:
         self.taxNodes[parentTI] = parentNode
         self.taxNodes[TI] = taxNode
 
+    def getDescendantSpecies(self, TI):
+        # species TIs in the subtree of a compact tree node, without the node itself
+        species = self.speciesCache.get(TI, None)
+        if species is None:
+            enter, exit, speciesEnter, speciesTIs = self.getSpeciesIndex()
+
+            i = self.compactTaxonomy.getIndex(TI)
+            start = np.searchsorted(speciesEnter, enter[i], side='right')
+            end = np.searchsorted(speciesEnter, exit[i], side='right')
+            species = self.speciesCache[TI] = frozenset(str(TI) for TI in speciesTIs[start:end].tolist())
+        return species
+
+    def getSpeciesIndex(self):
+        if self.speciesIndex is None:
+            self.speciesIndex = self.buildSpeciesIndex()
+        return self.speciesIndex
+
+    def buildSpeciesIndex(self):
+        SPECIES_RANK = "species"
+        taxonomy = self.compactTaxonomy
+        enter, exit = taxonomy.getSubtreeRanges()
+
+        codes = [code for code in range(len(taxonomy.ranks)) if taxonomy.ranks[code] == SPECIES_RANK]
+        species = np.flatnonzero(np.isin(taxonomy.rankCodes, codes) & (enter >= 0))
+        order = np.argsort(enter[species])
+        return enter, exit, enter[species][order], np.asarray(taxonomy.taxIds)[species][order]
+
+    def clearSpeciesIndex(self):
+        self.speciesIndex = None
+        self.speciesCache.clear()
+
+    def getAncestorsAtRank(self, TIs, rank):
+        # closest ancestor TI (or the TI itself) at the rank, None if there is none
+        if self.compactTaxonomy is None:
+            return [self.findAncestorAtRank(TI, rank) for TI in TIs]
+
+        taxonomy = self.compactTaxonomy
+        ancestors = self.getRankAncestors(rank)
+        indices = [taxonomy.getIndex(TI) for TI in TIs]
+        return [taxonomy.getTaxId(ancestors[i]) if i is not None and ancestors[i] >= 0 else None for i in indices]
+
+    def getRankAncestors(self, rank):
+        ancestors = self.rankAncestors.get(rank, None)
+        if ancestors is None:
+            taxonomy = self.compactTaxonomy
+            if rank in taxonomy.ranks:
+                ancestors = taxonomy.getRankAncestors(taxonomy.ranks.index(rank))
+            else:
+                ancestors = np.full(len(taxonomy.taxIds), -1, dtype=np.int32)
+            self.rankAncestors[rank] = ancestors
+        return ancestors
+
+    def findAncestorAtRank(self, TI, rank):
+        taxNode = self.taxNodes.get(TI, None)
+        while taxNode is not None:
+            if taxNode.rank == rank:
+                return taxNode.taxId
+            taxNode = taxNode.parent if taxNode.parent is not taxNode else None
+        return None
+
+    def clearAncestorIndex(self):
+        self.rankAncestors.clear()
+
     def taxIdHasName(self, taxId):
         name = self.taxonomyNames.get(taxId, None)
         return name is not None
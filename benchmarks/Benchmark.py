@@ -0,0 +1,198 @@
+import json
+import platform
+import resource
+import sys
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from multiprocessing import get_context
+from os import devnull, makedirs
+from os.path import abspath, dirname
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import process_time, time
+from SyntheticData import SyntheticData
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--reads", type=int, default=20000, help="reads in the alignments file")
+    parser.add_argument("--species", type=int, default=1000, help="species in the taxonomy")
+    parser.add_argument("--depth", type=int, default=6, help="ranks between the root and species")
+    parser.add_argument("--markers", type=int, default=20000, help="markers in the markers file")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--processes", type=int, default=1, help="processes for parsing and reducing")
+    parser.add_argument("--engines", nargs="+", choices=["python", "numpy"], default=["python", "numpy"])
+    parser.add_argument("--directory", default=None, help="directory for the generated files (kept)")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file with the measurements")
+    parser.add_argument("--baseline", default=None, help="earlier JSON output to compare against")
+    args = parser.parse_args()
+
+    directory = args.directory or mkdtemp(prefix="benchmark")
+    makedirs(directory, exist_ok=True)
+    data = SyntheticData(directory, args.seed, args.species, args.depth, args.markers, args.reads)
+    data.installResourceFiles()
+
+    print("Generating synthetic data...")
+    startTime = time()
+    data.generate()
+    print("\t\tNodes: {}, species: {}, time: {:.3f} s".format(len(data.nodes), len(data.speciesTIs),
+                                                              time() - startTime))
+    print("---Done.")
+
+    files = data.getResourceFiles()
+    # name, timed function, its arguments and an untimed preparation that replaces them
+    stages = [
+        ("taxonomy_build", buildTaxonomy, (), None),
+        ("taxonomy_snapshot_load", buildTaxonomy, (), None),
+        ("database_reducer", reduceDatabase, (args.processes,), None),
+        ("sam_ingest", parseAlignments, (files["ALIGNMENTS_FILE"], args.processes), None),
+        ("alignments_cache_load", loadCachedAlignments, (files["ALIGNMENTS_FILE"],), saveCachedAlignments),
+    ]
+    for engine in args.engines:
+        stages.append(("em_" + engine, runEM, (files["ALIGNMENTS_FILE"], engine), prepareEM))
+    stages.append(("em_incremental", runIncrementalEM, (files["ALIGNMENTS_FILE"],), prepareIncrementalEM))
+
+    results = {}
+    for name, function, arguments, prepare in stages:
+        results[name] = runStage(function, arguments, prepare)
+        print("{:24}{:>10.3f} s{:>14.0f} records/s{:>10.1f} MiB".format(
+            name, results[name]["time"], results[name]["throughput"], results[name]["peakRSS"] / 1024))
+        if results[name].get("maxDifference", 0) > 1e-9:
+            print("\t\tWarning: estimate differs from EMAlgorithm.getResult by {:.3g}".format(
+                results[name]["maxDifference"]))
+
+    report = {
+        "parameters": {"reads": args.reads, "species": args.species, "depth": args.depth, "markers": args.markers,
+                       "seed": args.seed, "processes": args.processes},
+        "python": platform.python_version(),
+        "stages": results,
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+    print("Measurements written to {}".format(args.output))
+
+    if args.baseline is not None:
+        compare(args.baseline, results)
+    if args.directory is None:
+        rmtree(directory)
+
+
+def runStage(function, arguments, prepare=None):
+    # every stage runs in a forked process, so the memory of earlier stages is not counted in its own
+    context = get_context("fork")
+    queue = context.Queue()
+    process = context.Process(target=measureStage, args=(queue, function, arguments, prepare))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def measureStage(queue, function, arguments, prepare):
+    # peak RSS of a forked process starts from the parent's resident set at the fork, so it is reported above that
+    forkRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with open(devnull, 'w') as output, redirect_stdout(output):
+        if prepare is not None:
+            arguments = prepare(*arguments)
+        startTime, startCpuTime = time(), process_time()
+        records, extra = function(*arguments)
+        wallTime, cpuTime = time() - startTime, process_time() - startCpuTime
+
+    result = {"time": wallTime, "cpuTime": cpuTime, "records": records, "throughput": records / max(wallTime, 1e-9),
+              "peakRSS": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - forkRSS, "forkRSS": forkRSS}     # KiB
+    result.update(extra)
+    queue.put(result)
+
+
+def buildTaxonomy():
+    from TaxonomyTree import TaxonomyTree
+
+    taxTree = TaxonomyTree()
+    taxTree.build()
+    return len(taxTree.compactTaxonomy.taxIds), {}
+
+
+def reduceDatabase(processes):
+    from DatabaseReducer import DatabaseReducer
+    from res.ResourceFiles import MARKERS_FILE
+
+    DatabaseReducer(processes).generate()
+    with open(MARKERS_FILE) as markers:
+        return sum(1 for line in markers), {}
+
+
+def parseAlignments(alignmentsFile, processes):
+    from SamParser import SamParser
+
+    alignments = SamParser.parseFile(alignmentsFile, {}, processes)
+    return len(alignments), {}
+
+
+def saveCachedAlignments(alignmentsFile):
+    from AlignmentsCache import AlignmentsCache
+    from SamParser import SamParser
+
+    if AlignmentsCache.load(alignmentsFile) is None:
+        AlignmentsCache.save(alignmentsFile, SamParser.parseFile(alignmentsFile, {}))
+    return alignmentsFile,
+
+
+def loadCachedAlignments(alignmentsFile):
+    from AlignmentsCache import AlignmentsCache
+
+    alignments = AlignmentsCache.load(alignmentsFile)
+    # reads are decoded on access, so the whole index is walked once
+    return sum(1 for read, alignment in alignments.items()), {}
+
+
+def prepareEM(alignmentsFile, engine):
+    from EMAlgorithm import EMAlgorithm
+    from SamParser import SamParser
+
+    em = EMAlgorithm()
+    em.engine = engine
+    em.calculateInitialParameters(alignmentsFile, SamParser.parseFile(alignmentsFile, {}))
+    return em,
+
+
+def runEM(em):
+    em.getResult()
+    return len(em.reads), {"iterations": em.iterations, "genomes": len(em.genomes)}
+
+
+def prepareIncrementalEM(alignmentsFile):
+    from EMAlgorithm import EMAlgorithm
+    from IncrementalEMAlgorithm import IncrementalEMAlgorithm
+    from SamParser import SamParser
+
+    alignments = SamParser.parseFile(alignmentsFile, {})
+    em = EMAlgorithm()
+    em.calculateInitialParameters(alignmentsFile, alignments)
+    incrementalEM = IncrementalEMAlgorithm()
+    incrementalEM.maxIterations = float("inf")
+    return incrementalEM, alignments, em.getResult()
+
+
+def runIncrementalEM(incrementalEM, alignments, expected):
+    # one batch with every read runs the same EM steps as getResult, so the estimates have to agree
+    result = dict((TI, pi) for pi, TI in incrementalEM.addBatch(alignments))
+    maxDifference = max(abs(pi - result.get(TI, 0)) for pi, TI in expected)
+    return len(incrementalEM.reads), {"iterations": incrementalEM.iterations, "maxDifference": maxDifference}
+
+
+def compare(baselineFile, results):
+    with open(baselineFile) as baseline:
+        baselineStages = json.load(baseline)["stages"]
+
+    print("\nCompared to {}:".format(baselineFile))
+    for name in sorted(results):
+        if name in baselineStages:
+            print("{:24}{:>10.2f}x time{:>10.2f}x peak RSS".format(
+                name, results[name]["time"] / max(baselineStages[name]["time"], 1e-9),
+                results[name]["peakRSS"] / max(baselineStages[name]["peakRSS"], 1)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import random
+import re
+import sys
+from os.path import join
+from types import ModuleType
+
+
+class SyntheticData:
+    # seeded stand-ins for the NCBI taxonomy dumps, the assembly summary, MetaPhlAn markers,
+    # coding sequences and graphmap alignments, written in the formats the analysis reads
+    RANKS = ["superkingdom", "phylum", "class", "order", "family", "genus"]
+    RANK_PREFIXES = {"superkingdom": "k", "phylum": "p", "class": "c", "order": "o", "family": "f", "genus": "g",
+                     "species": "s", "no rank": "t"}
+
+    def __init__(self, directory, seed=1, species=1000, depth=6, markers=20000, reads=20000):
+        self.directory = directory
+        self.seed = seed
+        self.species = species
+        self.depth = depth          # ranks between the root and species
+        self.markers = markers
+        self.reads = reads
+        self.random = random.Random(seed)
+        self.nodes = []             # TI, parent TI, rank, name
+        self.speciesTIs = []
+        self.markerKeys = []        # GI and position of every marker
+
+    def getResourceFiles(self):
+        return {
+            "NAMES_FILE": join(self.directory, "names.dmp"),
+            "NODES_FILE": join(self.directory, "nodes.dmp"),
+            "NODES_STATS_FILE": join(self.directory, "nodes_stats.txt"),
+            "STRAINS_ASSEMBLY_FILE": join(self.directory, "assembly_summary.txt"),
+            "MARKERS_FILE": join(self.directory, "markers.txt"),
+            "NOT_PAIRED_CLADES_FILE": join(self.directory, "not_paired.txt"),
+            "CODING_SEQUENCES_FILE": join(self.directory, "coding.txt"),
+            "REDUCED_DB_FILE": join(self.directory, "reduced.fa"),
+            "ALIGNMENTS_FILE": join(self.directory, "alignments.sam"),
+        }
+
+    def installResourceFiles(self):
+        # the analysis modules import their paths from res.ResourceFiles, so it has to be installed first
+        package, module = ModuleType("res"), ModuleType("res.ResourceFiles")
+        for name, path in self.getResourceFiles().items():
+            setattr(module, name, path)
+        package.ResourceFiles = module
+        sys.modules["res"], sys.modules["res.ResourceFiles"] = package, module
+
+    def generate(self):
+        files = self.getResourceFiles()
+        self.generateTaxonomy(files["NAMES_FILE"], files["NODES_FILE"])
+        self.generateAssemblySummary(files["STRAINS_ASSEMBLY_FILE"])
+        self.generateMarkers(files["MARKERS_FILE"])
+        self.generateCodingSequences(files["CODING_SEQUENCES_FILE"])
+        self.generateAlignments(files["ALIGNMENTS_FILE"])
+
+    def getRanks(self):
+        ranks = SyntheticData.RANKS[-self.depth:] if self.depth <= len(SyntheticData.RANKS) else SyntheticData.RANKS
+        return ["no rank"] * (self.depth - len(ranks)) + ranks
+
+    def generateTaxonomy(self, namesFile, nodesFile):
+        self.nodes = [("1", "1", "no rank", "root")]
+        level = ["1"]
+        for rank in self.getRanks():
+            # levels grow until the last one has about a tenth as many nodes as there are species
+            children = max(1, min(3, self.species // (10 * len(level))))
+            nextLevel = []
+            for parentTI in level:
+                for k in range(self.random.randint(1, children) if children > 1 else 1):
+                    nextLevel.append(self.addNode(parentTI, rank))
+            level = nextLevel
+
+        for k in range(self.species):
+            self.speciesTIs.append(self.addNode(self.random.choice(level), "species"))
+        for TI in list(self.speciesTIs):
+            if self.random.random() < 0.3:
+                self.addNode(TI, "no rank", "Strain")
+
+        with open(namesFile, 'w') as names, open(nodesFile, 'w') as nodes:
+            for TI, parentTI, rank, name in self.nodes:
+                names.write("{}\t|\t{}\t|\t\t|\tscientific name\t|\n".format(TI, name))
+                if self.random.random() < 0.2:
+                    names.write("{}\t|\t{} synonym\t|\t\t|\tsynonym\t|\n".format(TI, name))
+                nodes.write("{}\t|\t{}\t|\t{}\t|\t\t|\n".format(TI, parentTI, rank))
+
+    def addNode(self, parentTI, rank, namePrefix=None):
+        TI = str(len(self.nodes) + 1)
+        name = "{} {}".format(namePrefix or rank.capitalize(), TI)
+        self.nodes.append((TI, parentTI, rank, name))
+        return TI
+
+    def generateAssemblySummary(self, assemblyFile):
+        with open(assemblyFile, 'w') as assembly:
+            assembly.write("# assembly_accession\n")
+            for k in range(len(self.speciesTIs)):
+                if self.random.random() < 0.7:
+                    row = ["GCF_{:09d}.1".format(k)] + ["na"] * 5 + [self.speciesTIs[k], "Organism strain {}".format(k)]
+                    row += ["na"] * 9 + ["GCA_{:09d}.1".format(k), "na"]
+                    assembly.write("\t".join(row) + "\n")
+
+    def generateMarkers(self, markersFile):
+        with open(markersFile, 'w') as markers:
+            for m in range(self.markers):
+                TI, parentTI, rank, name = self.random.choice(self.nodes[1:])
+                clade = SyntheticData.RANK_PREFIXES[rank] + "__" + re.sub('[^0-9a-zA-Z]+', '_', name)
+                roll = self.random.random()
+                if roll < 0.05:
+                    clade = "t__GCF_{:09d}".format(self.random.randint(0, self.species))
+                elif roll < 0.08:
+                    clade = "s__Unknown_{}".format(m)
+
+                ext = ["GCF_{:09d}".format(self.random.randint(0, self.species))
+                       for k in range(self.random.randint(0, 3))]
+                GI, position = str(self.random.randint(1, 10 ** 8)), "c{}-{}".format(m, m + 100)
+                self.markerKeys.append((GI, position))
+                markers.write("gi|{}|ref|NZ_X.1|:{}\t{{'ext': set({!r}), 'score': 3.0, 'clade': '{}', 'len': 100, "
+                              "'taxon': 'k__Bacteria'}}\n".format(GI, position, ext, clade))
+
+    def generateCodingSequences(self, codingFile):
+        with open(codingFile, 'w') as coding:
+            for GI, position in self.markerKeys:
+                if self.random.random() < 0.9:
+                    coding.write("gi|{}|ref|NZ_X.1|:{}\tcoding sequence\n".format(GI, position))
+                    coding.write(self.getSequence(self.random.randint(100, 1000)) + "\n")
+
+    def generateAlignments(self, alignmentsFile):
+        # most reads come from a few abundant species, the rest are spread over the others
+        abundant = self.speciesTIs[:max(10, len(self.speciesTIs) // 50)]
+        with open(alignmentsFile, 'w') as alignments:
+            alignments.write("@HD\tVN:1.0\tSO:unsorted\n")
+            for r in range(self.reads):
+                if self.random.random() < 0.05:
+                    alignments.write("read{}\t4\t*\t0\t0\t*\t*\t0\t0\tACGT\t*\n".format(r))
+                    continue
+
+                species = abundant if self.random.random() < 0.8 else self.speciesTIs
+                TIs = self.random.sample(species, 1 if self.random.random() < 0.4 else self.random.randint(2, 4))
+                matches = self.random.randint(50, 500)
+                CIGAR = "{}M{}I{}M{}D{}M".format(matches, self.random.randint(0, 40), matches // 2,
+                                                 self.random.randint(0, 20), 10)
+                alignments.write("read{}\t0\tgi|{}|ti|{}\t1\t60\t{}\t*\t0\t0\tACGT\t*\n".format(
+                    r, self.random.randint(1, 10 ** 8), ",".join(TIs), CIGAR))
+
+    def getSequence(self, length):
+        return "".join(self.random.choice("ACGT") for k in range(length))